@@ -11,8 +11,8 @@ import numpy as np
 import time
 from sklearn.model_selection import KFold
 from datasets import LCs, CachedLCs
-from data_samplers import CachedRandomSampler
-from dataset_utils import cached_crossvalidator_split
+from data_samplers import CachedRandomSampler, ChunkShuffleSampler, ChunkBalancedSampler
+from dataset_utils import cached_crossvalidator_split, chunked_subset
 from experiment import Experiment
 from utils import load_statistics,save_statistics,find_best_epoch
 import pandas as pd
@@ -38,6 +38,9 @@ class CVExperiment(nn.Module):
         self.k = k
         self.verbose = verbose
         self.train_data = train_data
+        #DataLoader workers, see batch_loader
+        self.loader_params = {name: self.exp_params[name] for name in ["num_workers","prefetch_factor","persistent_workers"]
+            if self.exp_params and name in self.exp_params}
         
         if train_data:
             self.train_length = len(train_data)
@@ -46,6 +49,8 @@ class CVExperiment(nn.Module):
                 self.kf_length = int(self.train_length/self.k)
                 kf_lengths = [self.kf_length]*self.k
                 self.chunksize=self.exp_params['chunk_size'] if 'chunk_size' in self.exp_params else 100000
+                if hasattr(train_data, "shard_starts"):
+                    self.chunksize = train_data.chunk_size #shards are the chunks of ShardedLCs
                 self.kfs = cached_crossvalidator_split(train_data,kf_lengths,self.chunksize)
             # print(self.kfs)
 
@@ -96,10 +101,13 @@ class CVExperiment(nn.Module):
                 train_indices = self.train_data.indices[tr]
                 val_indices = self.train_data.indices[val]
 
-                train_dataset = CachedLCs(self.train_data.lc_length, self.train_data.dataset_file,self.chunksize,len(train_indices),train_indices,self.train_data.transform)
-                val_dataset = CachedLCs(self.train_data.lc_length, self.train_data.dataset_file,self.chunksize,len(val_indices),val_indices,self.train_data.transform)
+                train_dataset = chunked_subset(self.train_data, train_indices, self.chunksize)
+                val_dataset = chunked_subset(self.train_data, val_indices, self.chunksize)
 
-                train_sampler = CachedRandomSampler(train_dataset,chunk_size=self.chunksize)
+                if "balanced" in self.exp_params and self.exp_params["balanced"]:
+                    train_sampler = ChunkBalancedSampler(train_dataset,chunk_size=self.chunksize,n_classes=self.exp_params["num_output_classes"])
+                else:
+                    train_sampler = ChunkShuffleSampler(train_dataset,chunk_size=self.chunksize)
                 val_sampler = CachedRandomSampler(val_dataset,chunk_size=self.chunksize)
 
                 if self.test_data:
@@ -120,7 +128,8 @@ class CVExperiment(nn.Module):
                     train_data = train_dataset,
                     val_data = val_dataset,
                     test_data = self.test_data,
-                    verbose = self.verbose
+                    verbose = self.verbose,
+                    **self.loader_params
                 )
 
             else :
@@ -141,7 +150,8 @@ class CVExperiment(nn.Module):
                     train_data = train_dataset,
                     val_data = val_dataset,
                     test_data = self.test_data,
-                    verbose = self.verbose
+                    verbose = self.verbose,
+                    **self.loader_params
                 )
 
             start_time = time.time()
@@ -174,7 +184,8 @@ class CVExperiment(nn.Module):
                 num_output_classes= self.exp_params["num_output_classes"],
                 test_data = self.test_data,
                 best_idx = best_epoch,
-                verbose = self.verbose
+                verbose = self.verbose,
+                **self.loader_params
             )
             start_time = time.time()
             experiment.run_experiment(test_results,test_summary)
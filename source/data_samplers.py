@@ -1,8 +1,9 @@
 import torch
 import numpy as np
-from torch.utils.data import Sampler
+from torch.utils.data import Sampler, BatchSampler, Subset
 import h5py
 import random
+from collections import OrderedDict
 
 class CachedRandomSampler(Sampler):
     """Samples elements randomly from a random chunk of data loaded in memory
@@ -15,6 +16,7 @@ class CachedRandomSampler(Sampler):
 
     def __init__(self, data_source, chunk_size=100000):
         # print("DATASEt length in sampler"+str(len(data_source)))
+        self.data_source = data_source
         self.dataset_length = len(data_source)
         self.chunk_size = chunk_size 
         # print(data_source.indices)
@@ -22,6 +24,11 @@ class CachedRandomSampler(Sampler):
         self.current_chunk = np.floor(self.indices[0]/self.chunk_size)
 
     def __iter__(self):
+        #let the dataset know the order of chunks, so it can prefetch them
+        if hasattr(self.data_source, "schedule_chunks"):
+            chunks = np.floor(np.asarray(self.indices)/self.chunk_size).astype(int)
+            starts = np.concatenate(([True], chunks[1:] != chunks[:-1]))
+            self.data_source.schedule_chunks(chunks[starts].tolist())
         indices_in_chunk = 0
         it = torch.tensor([],dtype = torch.long)
         # print(self.indices)
@@ -50,4 +57,236 @@ class CachedRandomSampler(Sampler):
         # return iter(self.indices)
 
     def __len__(self):
-        return self.dataset_length
\ No newline at end of file
+        return self.dataset_length
+
+def storage_chunks(data_source, storage, chunk_size):
+    #chunk of each stored index, shards of different sizes are found from their starts (see ShardedLCs)
+    dataset = data_source.dataset if isinstance(data_source, Subset) else data_source
+    storage = np.asarray(storage).astype(np.int64)
+    if hasattr(dataset, "shard_starts"):
+        return dataset.chunks_of(storage)
+    return storage//chunk_size
+
+class ChunkShuffleSampler(Sampler):
+    """Samples elements in a random order that stays local to chunks: every epoch
+    chunks are visited in a random order, n_resident of them at a time, and the
+    elements of those chunks are shuffled together. With n_resident=1 each chunk is
+    loaded once per epoch by CachedLCs, higher values get closer to a full shuffle but
+    need a dataset holding that many chunks (e.g. LRUCachedLCs).
+
+    Arguments:
+        data_source : dataset to sample from, with the indices it covers in data_source.indices
+        chunk_size : size of chunks that will be loaded into memory,
+        in terms of number of objects
+        n_resident : number of chunks whose elements are interleaved
+    """
+
+    def __init__(self, data_source, chunk_size=100000, n_resident=1):
+        self.data_source = data_source
+        self.dataset_length = len(data_source)
+        self.chunk_size = chunk_size
+        self.n_resident = n_resident
+        self.indices = np.asarray(data_source.indices).astype(np.int64)
+        chunks = storage_chunks(data_source, self.indices, self.chunk_size)
+        order = np.argsort(chunks, kind="stable")
+        self.chunks, starts = np.unique(chunks[order], return_index=True)
+        self.chunk_indices = np.split(self.indices[order], starts[1:])
+
+    def __iter__(self):
+        chunk_order = torch.randperm(len(self.chunks)).numpy()
+        if hasattr(self.data_source, "schedule_chunks"):
+            self.data_source.schedule_chunks(self.chunks[chunk_order].tolist())
+        it = [np.zeros(0, dtype=np.int64)]
+        for first in range(0, len(chunk_order), self.n_resident):
+            group = np.concatenate([self.chunk_indices[c] for c in chunk_order[first:first+self.n_resident]])
+            it.append(group[torch.randperm(len(group)).numpy()])
+        return iter(np.concatenate(it).tolist())
+
+    def __len__(self):
+        return self.dataset_length
+
+
+
+def dataset_labels(data_source):
+    """Labels of the objects of a dataset, read at once instead of through __getitem__
+    Returns
+    -------
+    (positions, storage, labels) : indices to sample data_source with, where each of
+        them is stored in the file (to find its chunk) and its label
+    """
+    dataset = data_source.dataset if isinstance(data_source, Subset) else data_source
+    #only Y is read from the file, X is not loaded
+    dataset_file = getattr(dataset, "dataset_file", getattr(dataset, "dataset_h5", None))
+    if dataset_file is not None:
+        with h5py.File(dataset_file,'r') as f:
+            Y = f["Y"][:]
+    else:
+        Y = dataset.get_all_labels().cpu().numpy()
+    #chunked datasets are indexed by file row, so the indices they cover are already rows
+    indices = getattr(dataset, "indices", None)
+    storage = np.arange(len(Y)) if indices is None else np.asarray(indices).astype(np.int64)
+    positions = storage
+    if isinstance(data_source, Subset):
+        storage = np.asarray(data_source.indices).astype(np.int64)
+        positions = np.arange(len(data_source))
+    return positions, storage, Y[storage].astype(np.int64)
+
+def chunk_class_histogram(storage, labels, chunk_size, n_classes, storage_chunk=None):
+    """Counts the objects of each class in every chunk
+    Returns
+    -------
+    (chunks, histogram) : chunks with objects and a (len(chunks), n_classes) array of counts
+    """
+    if storage_chunk is None:
+        storage_chunk = np.asarray(storage)//chunk_size
+    chunks, chunk = np.unique(storage_chunk, return_inverse=True)
+    histogram = np.bincount(chunk*n_classes+labels, minlength=len(chunks)*n_classes).reshape((len(chunks), n_classes))
+    return chunks, histogram
+
+
+class ChunkBalancedSampler(Sampler):
+    """Samples the same number of elements of every class per epoch, drawing them chunk
+    by chunk so each chunk is loaded once per epoch. Each class's share is spread over
+    the chunks in proportion to where that class is (from a per chunk class histogram),
+    chunks are visited in random order and the draws of each chunk are shuffled.
+    Classes with fewer elements than their share are oversampled.
+
+    Arguments:
+        data_source : dataset (CachedLCs, LCs or a Subset of them) to sample from
+        chunk_size : size of chunks that will be loaded into memory,
+        in terms of number of objects
+        n_classes : number of classes, by default the largest label + 1
+        num_samples : elements per epoch, by default the size of the smallest class
+        times the number of classes (as with calculate_balance_weights)
+    """
+
+    def __init__(self, data_source, chunk_size=100000, n_classes=None, num_samples=None):
+        self.data_source = data_source
+        self.chunk_size = chunk_size
+        positions, storage, labels = dataset_labels(data_source)
+        self.n_classes = int(labels.max(initial=-1))+1 if n_classes is None else n_classes
+        storage_chunk = storage_chunks(data_source, storage, chunk_size)
+        self.chunks, self.histogram = chunk_class_histogram(storage, labels, chunk_size, self.n_classes, storage_chunk)
+        #positions grouped by chunk and class, group k*n_classes+c has class c of chunk k
+        chunk = np.searchsorted(self.chunks, storage_chunk)
+        order = np.lexsort((labels, chunk))
+        self.groups = np.split(positions[order], np.cumsum(self.histogram.ravel())[:-1])
+        class_counts = self.histogram.sum(axis=0)
+        self.classes = np.nonzero(class_counts)[0]
+        if num_samples is None:
+            num_samples = int(class_counts[self.classes].min()*len(self.classes)) if len(self.classes) else 0
+        self.num_samples = num_samples
+
+    def __iter__(self):
+        #numpy generator seeded from torch, so torch.manual_seed makes epochs reproducible
+        rng = np.random.default_rng(int(torch.randint(0, 2**31, (1,))))
+        class_counts = self.histogram.sum(axis=0)
+        shares = np.zeros(self.n_classes, dtype=np.int64)
+        shares[self.classes] = self.num_samples//len(self.classes)
+        shares[rng.choice(self.classes, self.num_samples%len(self.classes), replace=False)] += 1
+        quotas = np.zeros(self.histogram.shape, dtype=np.int64)
+        for c in self.classes:
+            quotas[:, c] = rng.multinomial(shares[c], self.histogram[:, c]/class_counts[c])
+
+        chunk_order = rng.permutation(len(self.chunks))
+        if hasattr(self.data_source, "schedule_chunks"):
+            self.data_source.schedule_chunks(self.chunks[chunk_order].tolist())
+        it = [np.zeros(0, dtype=np.int64)]
+        for k in chunk_order:
+            drawn = [rng.choice(self.groups[k*self.n_classes+c], quotas[k, c], replace=quotas[k, c] > self.histogram[k, c])
+                for c in np.nonzero(quotas[k])[0]]
+            if drawn:
+                it.append(rng.permutation(np.concatenate(drawn)))
+        return iter(np.concatenate(it).tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+class WorkerChunkBatchSampler(BatchSampler):
+    """Batches of a sampler for a DataLoader with num_workers workers over a chunked dataset.
+    The DataLoader hands batches to workers round-robin and each worker caches its own
+    chunks, so plain batches would make every worker read (and decompress) every chunk.
+    Instead, the sampler's order is cut at chunk boundaries into num_workers contiguous
+    runs of about the same length, each run is batched separately and the batches are
+    interleaved so that worker w gets the batches of run w, and each chunk is read by a
+    single worker (only runs of different lengths make the last batches cross over).
+
+    Arguments:
+        sampler : sampler giving the order of indices, e.g. ChunkShuffleSampler
+        batch_size : size of batches
+        num_workers : number of DataLoader workers
+        chunks_of : function, takes an array of indices and returns the chunk of each
+    """
+
+    def __init__(self, sampler, batch_size, num_workers, chunks_of):
+        super().__init__(sampler, batch_size, drop_last=False)
+        self.num_workers = num_workers
+        self.chunks_of = chunks_of
+
+    def __iter__(self):
+        order = np.fromiter(iter(self.sampler), dtype=np.int64)
+        chunks = self.chunks_of(order)
+        boundaries = np.nonzero(chunks[1:] != chunks[:-1])[0]+1
+        #cut at the chunk boundary closest to each of the even splits
+        targets = np.arange(1, self.num_workers)*len(order)/self.num_workers
+        if len(boundaries):
+            cuts = boundaries[np.abs(boundaries[None, :]-targets[:, None]).argmin(axis=1)]
+        else:
+            cuts = np.zeros(0, dtype=np.int64)
+        runs = np.split(order, np.unique(cuts))
+        batches = [[run[start:start+self.batch_size].tolist() for start in range(0, len(run), self.batch_size)]
+            for run in runs]
+        for k in range(max(len(b) for b in batches)):
+            for run_batches in batches:
+                if k < len(run_batches):
+                    yield run_batches[k]
+
+def chunk_loads(order, chunk_size, n_resident=1):
+    """Number of chunk loads needed to serve indices in the given order, holding
+    up to n_resident chunks in memory (least recently used one is evicted)"""
+    chunks = np.asarray(order, dtype=np.int64)//chunk_size
+    if chunks.size == 0:
+        return 0
+    #consecutive accesses to the same chunk never load anything
+    chunks = chunks[np.concatenate(([True], chunks[1:] != chunks[:-1]))]
+    resident = OrderedDict()
+    loads = 0
+    for chunk in chunks.tolist():
+        if chunk in resident:
+            resident.move_to_end(chunk)
+            continue
+        loads += 1
+        resident[chunk] = True
+        if len(resident) > n_resident:
+            resident.popitem(last=False)
+    return loads
+
+def shuffle_quality(order, labels=None, batch_size=64):
+    """Measures how close an order of indices is to a true shuffle
+    Parameters
+    ----------
+    order: list or array of indices, as given by a sampler
+    labels: array, optional. Class of each index (labels[i] is the class of index i)
+    batch_size: int, optional. Batches where class proportions are compared
+    Returns
+    -------
+    quality : dict with
+        index_correlation, rank correlation between position in order and index
+            (0 for a true shuffle, 1 for storage order)
+        batch_class_distance, if labels are given, mean total variation distance between
+            the class proportions of each batch and of the whole order (close to 0 for a true
+            shuffle, 1 when batches hold a single class not seen elsewhere)
+    """
+    order = np.asarray(order, dtype=np.int64)
+    ranks = np.argsort(np.argsort(order))
+    quality = {"index_correlation": float(np.corrcoef(np.arange(order.size), ranks)[0, 1])}
+    if labels is not None:
+        order_labels = np.asarray(labels)[order]
+        classes, order_labels = np.unique(order_labels, return_inverse=True)
+        n_batches = int(np.ceil(order.size/batch_size))
+        batch = np.arange(order.size)//batch_size
+        counts = np.bincount(batch*classes.size+order_labels, minlength=n_batches*classes.size).reshape((n_batches, classes.size))
+        batch_proportions = counts/counts.sum(axis=1, keepdims=True)
+        proportions = np.bincount(order_labels, minlength=classes.size)/order.size
+        quality["batch_class_distance"] = float(np.abs(batch_proportions-proportions).sum(axis=1).mean()/2)
+    return quality
@@ -1,31 +1,180 @@
 import torch
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Subset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
 import h5py
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from data_samplers import WorkerChunkBatchSampler, ChunkShuffleSampler
+from preprocess_data_utils import load_raw_vectors, load_raw_vectors_by_ids, read_label_index, rows_of_ids, load_vectors_by_ids, memmap_vectors, \
+    read_vector_rows, vector_channels, observation_offsets, observation_points, observation_distances
+from shard_utils import read_manifest, shard_files
+
+"""Datasets can be indexed with a list (or array) of indices, which gathers the whole
+batch with one indexing operation. Use them through batch_loader, or a BatchSampler
+with batch_size=None, so batches skip per sample __getitem__ calls and collate."""
+
+def is_batch_index(idx):
+    return isinstance(idx, (list, np.ndarray)) or (torch.is_tensor(idx) and idx.dim() > 0)
+
+def transformed_batch(batch, transform):
+    #transforms work on single samples, so they are applied one by one and stacked back
+    if not transform:
+        return batch
+    samples = [transform(sample) for sample in zip(*batch)]
+    return tuple(torch.stack(values) for values in zip(*samples))
+
+def gather_from_chunks(idxs, chunk_size, get_chunk, chunk_starts=None):
+    """Gathers a batch from a chunked dataset, with one indexing operation per chunk
+    the batch touches (usually one).
+    Parameters
+    ----------
+    idxs: list or array of indices
+    chunk_size: int, number of objects per chunk
+    get_chunk: function, takes a chunk number and returns its (X, Y, ids) tensors
+    chunk_starts: array, optional. First index of each chunk, for chunks of different
+        sizes (chunk_size is ignored then)
+    Returns
+    -------
+    (X, Y, ids) : tensors for the batch, in the order of idxs
+    """
+    idxs = np.asarray(idxs, dtype=np.int64)
+    if chunk_starts is None:
+        chunks = idxs//chunk_size
+        starts = chunks*chunk_size
+    else:
+        chunks = np.searchsorted(chunk_starts, idxs, side="right")-1
+        starts = np.asarray(chunk_starts, dtype=np.int64)[chunks]
+    first = np.unique(chunks, return_index=True)[1]
+    parts = []
+    positions = []
+    for chunk in chunks[np.sort(first)]:
+        in_chunk = np.nonzero(chunks == chunk)[0]
+        X, Y, ids = get_chunk(int(chunk))
+        local = torch.as_tensor(idxs[in_chunk]-starts[in_chunk], device=X.device)
+        parts.append((X[local], Y[local], ids[local]))
+        positions.append(in_chunk)
+    if len(parts) == 1:
+        return parts[0]
+    order = torch.as_tensor(np.argsort(np.concatenate(positions)), device=parts[0][0].device)
+    return tuple(torch.cat(values)[order] for values in zip(*parts))
+
+def batch_loader(data, batch_size, sampler=None, shuffle=True, num_workers=0, prefetch_factor=2, persistent_workers=False):
+    """DataLoader that asks data for whole batches at a time (see is_batch_index) when
+    it can, and falls back to a regular DataLoader otherwise.
+    Parameters
+    ----------
+    data: Dataset or Subset
+    batch_size: int
+    sampler: Sampler, optional. Order of the indices, random (or sequential if not shuffle) by default
+    num_workers: int, optional. Processes reading (and decompressing) batches in parallel with
+        training, 0 reads them in the main process. Each worker keeps its own file handle and
+        chunks (see worker_init), so chunked datasets hold up to num_workers chunks in memory
+    prefetch_factor: int, optional. Batches read ahead by each worker
+    persistent_workers: bool, optional. Keep workers (and their cached chunks) between epochs
+
+    Chunked datasets (with chunks_of) read with workers get a WorkerChunkBatchSampler, so
+    each worker gets a contiguous run of chunks and every chunk is read by one worker
+    """
+    dataset = data.dataset if isinstance(data, Subset) else data
+    #batches of data kept in host memory are staged in pinned memory, so they can be
+    #copied to the GPU asynchronously
+    pin_memory = torch.cuda.is_available() and getattr(dataset, "device", torch.device('cpu')).type == 'cpu'
+    workers = {"num_workers": num_workers}
+    if num_workers > 0:
+        workers.update(prefetch_factor=prefetch_factor, persistent_workers=persistent_workers, worker_init_fn=worker_init)
+        if isinstance(dataset, LCs):
+            #loaded once here, instead of once per worker
+            dataset.prefetch()
+    if not hasattr(dataset, "get_batch"):
+        return DataLoader(data, batch_size=batch_size, sampler=sampler, shuffle=shuffle if sampler is None else None,
+            pin_memory=pin_memory, **workers)
+    if sampler is None and shuffle and isinstance(data, ShardedLCs):
+        #random sampling would read a whole shard for almost every batch
+        sampler = ChunkShuffleSampler(data, data.chunk_size)
+    if sampler is None:
+        sampler = RandomSampler(data) if shuffle else SequentialSampler(data)
+    batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+    if num_workers > 0 and hasattr(dataset, "chunks_of"):
+        chunks_of = dataset.chunks_of
+        if isinstance(data, Subset):
+            subset_indices = np.asarray(data.indices, dtype=np.int64)
+            chunks_of = lambda idxs: dataset.chunks_of(subset_indices[idxs])
+        batch_sampler = WorkerChunkBatchSampler(sampler, batch_size, num_workers, chunks_of)
+    return DataLoader(data, batch_size=None, sampler=batch_sampler, pin_memory=pin_memory, **workers)
+
+def worker_init(worker_id):
+    """worker_init_fn of the DataLoaders made by batch_loader. Each worker has its own copy
+    of the dataset, which can't share the parent's h5py handle or reading thread (forked
+    workers inherit them), so they are dropped and the worker opens its own on first read"""
+    dataset = torch.utils.data.get_worker_info().dataset
+    while isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    if hasattr(dataset, "init_worker"):
+        dataset.init_worker()
+
+def data_device(device=None):
+    """Where datasets keep their data: host memory, unless another device is given.
+    Experiment moves each batch to the training device (see batch_loader for pinning)"""
+    return torch.device('cpu') if device is None else torch.device(device)
+
+def vector_dtype(storage_dtype=None):
+    """Type vectors are held in memory as: float32, unless a 16 bit type (torch.float16,
+    torch.bfloat16 or their names) is given to halve the memory they use. Datasets upcast
+    batches back to float32 when they are gathered"""
+    if storage_dtype is None:
+        return torch.float
+    if isinstance(storage_dtype, str):
+        return getattr(torch, storage_dtype)
+    return storage_dtype
+
+def upcast(batch):
+    X, Y, ids = batch
+    return X.float(), Y, ids
+
+def read_vectors(hf, n_channels, lc_length, device, dtype, block_rows=100000):
+    """Reads X[:, 0:n_channels, 0:lc_length] of an open .hdf5 file into a tensor of dtype, a block
+    of rows at a time, so there is never a whole copy of X in another type in memory
+    (distance channels of compact files are computed block by block, see read_vector_rows)"""
+    X = hf["X"]
+    shape = (X.shape[0], min(n_channels, vector_channels(hf)), min(lc_length, X.shape[2]))
+    vectors = torch.empty(shape, device=device, dtype=dtype)
+    obs_offsets = observation_offsets(hf)
+    for start in range(0, shape[0], block_rows):
+        vectors[start:start+block_rows] = torch.from_numpy(read_vector_rows(hf, start, start+block_rows, n_channels, lc_length,
+            obs_offsets))
+    return vectors
+
+def vectors_by_ids(dataset_file, ids, id_index, device, lc_length=None, n_channels=None):
+    #reads only the rows of ids from the file, see load_vectors_by_ids
+    X, obj_ids, Y = load_vectors_by_ids(dataset_file, ids, id_index, lc_length, n_channels)
+    return torch.tensor(X, device = device, dtype=torch.float), torch.tensor(Y, device = device, dtype=torch.long), \
+        torch.tensor(obj_ids, device = device, dtype=torch.int)
 
 class LCs(Dataset):
-    def __init__(self, lc_length, dataset_h5,n_channels=4,transform=None):
+    def __init__(self, lc_length, dataset_h5,n_channels=4,transform=None,device=None,storage_dtype=None):
 
         self.lc_length = lc_length
         self.dataset_h5 = dataset_h5
-        self.device = torch.device('cuda')
+        self.device = data_device(device)
+        self.storage_dtype = vector_dtype(storage_dtype)
         self.X = None
         self.Y = None
         self.ids = None
         self.transform = transform
         self.length = None
         self.n_channels = n_channels
+        self.id_index = None
 
+        #only the shape is read here, data is loaded once, on first access or with prefetch
         try:
             with h5py.File(self.dataset_h5,'r') as f:
-                X = f["X"][:,0:self.n_channels,0:self.lc_length]
-                Y = f["Y"]
-                ids = f["ids"]
-                print(X[0].shape)
-                print(len(X))
-                self.length = len(X)
-              
+                shape = f["X"].shape
+                print((min(self.n_channels, vector_channels(f)), min(self.lc_length, shape[2])))
+                print(shape[0])
+                self.length = shape[0]
+
         except Exception as e:
             print(e)
 
@@ -36,32 +185,37 @@ class LCs(Dataset):
 
         if self.X is None:
             self.load_data_into_memory()
-        sample = self.X[idx],self.Y[idx], self.ids[idx]
+        if is_batch_index(idx):
+            return self.get_batch(idx)
+        sample = self.X[idx].float(),self.Y[idx], self.ids[idx]
         if self.transform:
             return self.transform(sample)
         else:
             return sample
 
+    def prefetch(self):
+        """Loads the data now instead of on first access"""
+        if self.X is None:
+            self.load_data_into_memory()
+        return self
+
     def load_data_into_memory(self):
         try:
             with h5py.File(self.dataset_h5,'r') as f:
-                X = f["X"][:,0:self.n_channels,0:self.lc_length]
                 Y = f["Y"]
                 ids = f["ids"]
-                self.X = torch.tensor(X, device = self.device, dtype=torch.float)
+                self.X = read_vectors(f, self.n_channels, self.lc_length, self.device, self.storage_dtype)
                 self.ids = torch.tensor(ids, device = self.device, dtype=torch.int)
                 self.Y = torch.tensor(Y, device = self.device, dtype=torch.long)
         except Exception as e:
             print(e)
 
     def get_samples_per_class(self,n_classes):
-        if self.Y is None:
-            self.load_data_into_memory()
+        #counts come from the file's label index, data doesn't need to be loaded
         self.n_classes = n_classes
+        class_counts = read_label_index(self.dataset_h5, ["class_counts"])["class_counts"][0:n_classes]
         counts = torch.zeros(n_classes)
-        for i in np.arange(n_classes):
-            idx = torch.where(self.Y == i)[0]
-            counts[i] = len(self.Y[idx])
+        counts[0:len(class_counts)] = torch.tensor(class_counts, dtype=torch.float)
         return counts
 
     def get_all_labels(self):
@@ -70,36 +224,152 @@ class LCs(Dataset):
         return self.Y
 
     def get_items(self,idxs):
-        X = self.X[idxs]
+        if self.X is None:
+            self.load_data_into_memory()
+        X = self.X[idxs].float()
         Y = self.Y[idxs]
         ids = self.ids[idxs]
-        return X, Y, ids         
+        return X, Y, ids
+
+    def get_batch(self,idxs):
+        return transformed_batch(self.get_items(torch.as_tensor(idxs, device=self.device)), self.transform)
+
+    def get_by_ids(self, ids):
+        """Returns (X, Y, ids) of the objects with the given ids, in that order. If the
+        data is not in memory, only their rows are read from the file"""
+        if self.id_index is None:
+            self.id_index = read_label_index(self.dataset_h5, ["sorted_ids", "id_rows"])
+        if self.X is None:
+            return vectors_by_ids(self.dataset_h5, ids, self.id_index, self.device, self.lc_length, self.n_channels)
+        rows = rows_of_ids(ids, self.id_index["sorted_ids"], self.id_index["id_rows"])
+        return self.get_items(torch.as_tensor(rows, device=self.device))
+
+
+class RawLCs(LCs):
+    """Same as LCs, but reads a raw light curves file (see save_raw_lcs) and builds
+    the vectors at lc_length when the data is loaded, so a single file can be used
+    to try any length"""
+    def __init__(self, lc_length, dataset_h5, n_channels=4, transform=None, batch_size=100000, device=None, storage_dtype=None):
+
+        self.lc_length = lc_length
+        self.dataset_h5 = dataset_h5
+        self.device = data_device(device)
+        self.storage_dtype = vector_dtype(storage_dtype)
+        self.X = None
+        self.Y = None
+        self.ids = None
+        self.transform = transform
+        self.length = None
+        self.n_channels = n_channels
+        self.id_index = None
+        self.batch_size = batch_size
+
+        try:
+            with h5py.File(self.dataset_h5,'r') as f:
+                self.length = len(f["ids"])
+        except Exception as e:
+            print(e)
+
+    def get_by_ids(self, ids):
+        """Returns (X, Y, ids) of the objects with the given ids, in that order. If the
+        data is not in memory, only their points are read from the file and vectorized"""
+        if self.id_index is None:
+            self.id_index = read_label_index(self.dataset_h5, ["sorted_ids", "id_rows"])
+        if self.X is not None:
+            return super().get_by_ids(ids)
+        X, obj_ids, Y = load_raw_vectors_by_ids(self.dataset_h5, ids, self.id_index, self.lc_length)
+        return torch.tensor(X[:,0:self.n_channels], device = self.device, dtype=torch.float), \
+            torch.tensor(Y, device = self.device, dtype=torch.long), torch.tensor(obj_ids, device = self.device, dtype=torch.int)
+
+    def load_data_into_memory(self):
+        try:
+            X, ids, Y = load_raw_vectors(self.dataset_h5, self.lc_length, self.batch_size)
+            self.X = torch.tensor(X[:,0:self.n_channels], device = self.device, dtype=self.storage_dtype)
+            self.ids = torch.tensor(ids, device = self.device, dtype=torch.int)
+            self.Y = torch.tensor(Y, device = self.device, dtype=torch.long)
+        except Exception as e:
+            print(e)
+
+
+class MemmapLCs(LCs):
+    """Same as LCs, but X is memory mapped from a file with contiguous, uncompressed vectors
+    (converted with relayout_vectors(codec="contiguous") or scripts/relayout_dataset.py)
+    instead of being decompressed and copied into a tensor. Loading is instant and the OS
+    reads (and caches) the pages that batches touch. Data stays in host memory, in the type
+    it was stored as (e.g. float16, see relayout_vectors), and batches are upcast and moved
+    to device when they are gathered. Distance channels of compact files (see
+    create_compact_vectors) are computed per batch from their (mapped) observations"""
+
+    def __getstate__(self):
+        #copies (or worker processes) map the file again instead of copying the data
+        state = self.__dict__.copy()
+        state["X"] = None
+        state["obs_time"] = None
+        return state
+
+    def __getitem__(self, idx):
+        if is_batch_index(idx):
+            return self.get_batch(idx)
+        sample = self.get_items(idx)
+        if self.transform:
+            return self.transform(sample)
+        else:
+            return sample
+
+    def load_data_into_memory(self):
+        #a view of the first n_channels and lc_length points, nothing is read here
+        X = memmap_vectors(self.dataset_h5)[:,0:self.n_channels,0:self.lc_length]
+        self.X = torch.from_numpy(X)
+        with h5py.File(self.dataset_h5,'r') as f:
+            self.ids = torch.tensor(f["ids"][:], dtype=torch.int)
+            self.Y = torch.tensor(f["Y"][:], dtype=torch.long)
+            self.n_distances = min(self.n_channels, vector_channels(f))-X.shape[1]
+            if "obs_time" in f:
+                self.obs_counts = f["obs_counts"][:]
+                self.obs_offsets = observation_offsets(f)
+                self.obs_time = memmap_vectors(self.dataset_h5, name="obs_time")
+
+    def get_items(self, idxs):
+        if self.X is None:
+            self.load_data_into_memory()
+        idxs = torch.as_tensor(idxs).cpu()
+        X = self.X[idxs].to(dtype=torch.float)
+        if self.n_distances > 0:
+            rows = np.atleast_1d(idxs.numpy())
+            X_void = observation_distances(self.obs_counts[rows], self.obs_time[observation_points(self.obs_offsets, rows)],
+                X.shape[-1])[:, 0:self.n_distances]
+            X = torch.cat((X, torch.from_numpy(X_void).reshape(X.shape[:-2]+(-1, X.shape[-1]))), dim=-2)
+        return X.to(self.device), self.Y[idxs].to(self.device), self.ids[idxs].to(self.device)
+
+    def get_batch(self, idxs):
+        return transformed_batch(self.get_items(idxs), self.transform)
 
 
 class InefficientCachedLCs(Dataset):
 
-    def __init__(self,lc_length, dataset_file, data_cache_size=100000, transform=None):
+    def __init__(self,lc_length, dataset_file, data_cache_size=100000, transform=None, device=None):
 
         self.lc_length = lc_length
-        self.device = torch.device('cuda')
+        self.device = data_device(device)
         self.data_cache = {}
         self.transform = transform
         self.data_cache_size = data_cache_size
         self.dataset_file = dataset_file
         self.dataset_length = 0
+        self.h5_file = None
+        self.obs_offsets = None
         
         try:
             with h5py.File(self.dataset_file,'r') as f:
-                X = f["X"]
                 Y = f["Y"]
                 ids = f["ids"]
                 self.dataset_length = len(ids)
+                X = read_vector_rows(f, 0, min(self.data_cache_size, self.dataset_length), lc_length=self.lc_length)
 
-                for i in np.arange(self.data_cache_size):
-                    X = torch.tensor(X[i,:,0:self.lc_length], device = self.device, dtype=torch.float)
-                    Y = torch.tensor(Y[i], device = self.device, dtype=torch.long)
-                    ids = torch.tensor(ids[i], device = self.device, dtype=torch.int)
-                    sample = X, Y, ids
+                for i in np.arange(min(self.data_cache_size, self.dataset_length)):
+                    sample = torch.tensor(X[i,:,0:self.lc_length], device = self.device, dtype=torch.float), \
+                        torch.tensor(Y[i], device = self.device, dtype=torch.long), \
+                        torch.tensor(ids[i], device = self.device, dtype=torch.int)
                     self.add_to_cache(sample, i)
         except Exception as e:
             print(e)
@@ -112,16 +382,16 @@ class InefficientCachedLCs(Dataset):
         if idx in self.data_cache:
             sample = self.data_cache[idx]
         else:
-            with h5py.File(self.dataset_file,'r') as h5_file:
-                idx = int(idx)
-                X = h5_file["X"][idx,:,0:self.lc_length]
-                Y = h5_file["Y"][idx]
-                ids = h5_file["ids"][idx]
-                X = torch.tensor(X, device = self.device, dtype=torch.float)
-                Y = torch.tensor(Y, device = self.device, dtype=torch.long)
-                ids = torch.tensor(ids, device = self.device, dtype=torch.int)
-                sample = X, Y, ids
-                self.add_to_cache(sample, idx)
+            h5_file = self.open_file()
+            idx = int(idx)
+            X = read_vector_rows(h5_file, idx, idx+1, lc_length=self.lc_length, obs_offsets=self.obs_offsets)[0]
+            Y = h5_file["Y"][idx]
+            ids = h5_file["ids"][idx]
+            X = torch.tensor(X, device = self.device, dtype=torch.float)
+            Y = torch.tensor(Y, device = self.device, dtype=torch.long)
+            ids = torch.tensor(ids, device = self.device, dtype=torch.int)
+            sample = X, Y, ids
+            self.add_to_cache(sample, idx)
 
         if self.transform:
             return self.transform(sample)
@@ -134,13 +404,37 @@ class InefficientCachedLCs(Dataset):
             del self.data_cache[random.choice(list(self.data_cache))]
         self.data_cache[str(idx)] = sample
 
+    def __getstate__(self):
+        #h5py handles can't be copied, copies (or worker processes) open their own
+        state = self.__dict__.copy()
+        state["h5_file"] = None
+        return state
+
+    def open_file(self):
+        #opened on the first miss and kept open, once per worker process (see worker_init)
+        if self.h5_file is None:
+            self.h5_file = h5py.File(self.dataset_file,'r')
+            self.obs_offsets = observation_offsets(self.h5_file)
+        return self.h5_file
+
+    def init_worker(self):
+        self.h5_file = None
+
 
 class CachedLCs(Dataset):
+    """Dataset that keeps a single chunk of chunk_size light curves in memory, loading
+    a new one whenever an index outside of it is asked for. With prefetch=True, the chunk
+    that will be needed next (in the order given by the sampler through schedule_chunks,
+    or the following one otherwise) is read in a background thread while the current one
+    is being used, so swapping chunks does not have to wait for the file.
+    """
 
-    def __init__(self,lc_length, dataset_file, chunk_size=100000, dataset_length=None, indices=None, transform=None):
+    def __init__(self,lc_length, dataset_file, chunk_size=100000, dataset_length=None, indices=None, transform=None, prefetch=False,
+        device=None, storage_dtype=None):
 
         self.lc_length = lc_length
-        self.device = torch.device('cuda')
+        self.device = data_device(device)
+        self.storage_dtype = vector_dtype(storage_dtype)
 
         self.chunk_size = chunk_size
         self.dataset_file = dataset_file
@@ -153,11 +447,21 @@ class CachedLCs(Dataset):
         self.dataset_length = dataset_length
         self.true_dataset_length = None
         self.indices = indices
+        self.id_index = None
 
         self.low_idx = 0
-        self.high_idx = -1
+        self.high_idx = 0
         self.loading_data=0
 
+        self.prefetch = prefetch
+        self.chunk_order = None
+        self.current_chunk = None
+        self.next_chunk = None #(chunk, future) being read in the background
+        self.executor = None
+        self.load_wait_time = 0 #time spent waiting for chunks, in seconds
+        self.h5_file = None
+        self.obs_offsets = None
+
         try:
             with h5py.File(self.dataset_file,'r') as f:
                 X = f["X"]
@@ -179,45 +483,386 @@ class CachedLCs(Dataset):
 
     def __getitem__(self, idx):
         # print(idx)
-        if idx <= self.high_idx and idx >=self.low_idx: #if index asked for is in cache, return it
-            idx = int(idx-self.low_idx)
-            sample = self.X[idx], self.Y[idx], self.ids[idx]
-        else: #if index asked for is not in cache, load it
+        if is_batch_index(idx):
+            return self.get_batch(idx)
+        if idx >= self.high_idx or idx < self.low_idx: #if index asked for is not in cache, load it
+            self.get_chunk(int(idx//self.chunk_size))
+        idx = int(idx-self.low_idx)
+        sample = self.X[idx].float(), self.Y[idx], self.ids[idx]
+
+        if self.transform:
+            # print("hay transform")
+            # print(self.transform)
+            # print(sample)
+            return self.transform(sample)
+        else:
+            return sample
+
+    def __getstate__(self):
+        #background reads and h5py handles can't be copied, the copy starts without them
+        state = self.__dict__.copy()
+        state["executor"] = None
+        state["next_chunk"] = None
+        state["h5_file"] = None
+        return state
+
+    def init_worker(self):
+        """Called in each DataLoader worker (see worker_init). Only the main process knows
+        the order of chunks (schedule_chunks), so workers don't prefetch in the background,
+        they read ahead through the DataLoader's prefetch_factor instead"""
+        self.executor = None
+        self.next_chunk = None
+        self.h5_file = None
+        self.prefetch = False
+
+    def open_file(self):
+        #opened on the first read and kept open, once per worker process
+        if self.h5_file is None:
+            self.h5_file = h5py.File(self.dataset_file,'r')
+            self.obs_offsets = observation_offsets(self.h5_file)
+        return self.h5_file
+
+    def get_batch(self, idxs):
+        return transformed_batch(upcast(gather_from_chunks(idxs, self.chunk_size, self.get_chunk)), self.transform)
+
+    def chunks_of(self, idxs):
+        return np.asarray(idxs, dtype=np.int64)//self.chunk_size
+
+    def get_by_ids(self, ids):
+        """Returns (X, Y, ids) of the objects with the given ids, in that order, reading
+        only their rows from the file"""
+        if self.id_index is None:
+            self.id_index = read_label_index(self.dataset_file, ["sorted_ids", "id_rows"])
+        return vectors_by_ids(self.dataset_file, ids, self.id_index, self.device, self.lc_length)
+
+    def get_chunk(self, chunk):
+        if chunk != self.current_chunk:
             print("loading data")
             self.loading_data=self.loading_data+1
             print(self.loading_data)
+            self.load_chunk(chunk)
+        return self.X, self.Y, self.ids
+
+    def schedule_chunks(self, chunk_order):
+        """Tells the dataset in which order chunks are going to be accessed (e.g. by a
+        sampler, at the beginning of every epoch), so the right one is prefetched"""
+        self.chunk_order = list(chunk_order)
+        if self.prefetch and len(self.chunk_order) > 0 and self.chunk_order[0] != self.current_chunk:
+            self.start_reading(self.chunk_order[0])
+
+    def chunk_bounds(self, chunk):
+        low_idx = chunk*self.chunk_size
+        return low_idx, min(low_idx+self.chunk_size, self.true_dataset_length)
+
+    def read_chunk(self, chunk):
+        low_idx, high_idx = self.chunk_bounds(chunk)
+        f = self.open_file()
+        return read_vector_rows(f, low_idx, high_idx, lc_length=self.lc_length, obs_offsets=self.obs_offsets), \
+            f["Y"][low_idx:high_idx], f["ids"][low_idx:high_idx]
+
+    def start_reading(self, chunk):
+        if self.next_chunk is not None and self.next_chunk[0] == chunk:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        self.open_file() #from this thread, so the reading thread doesn't race to open it
+        self.next_chunk = chunk, self.executor.submit(self.read_chunk, chunk)
+
+    def following_chunk(self, chunk):
+        #next chunk in the sampler's order, wrapping around for the next epoch
+        if self.chunk_order and chunk in self.chunk_order:
+            return self.chunk_order[(self.chunk_order.index(chunk)+1)%len(self.chunk_order)]
+        n_chunks = int(np.ceil(self.true_dataset_length/self.chunk_size))
+        return (chunk+1)%n_chunks
+
+    def load_chunk(self, chunk):
+        start_time = time.time()
+        if self.next_chunk is not None and self.next_chunk[0] == chunk:
+            X, Y, ids = self.next_chunk[1].result()
+        else:
+            X, Y, ids = self.read_chunk(chunk)
+        self.next_chunk = None
+        # stats = torch.cuda.memory_allocated()
+        # print("STATS before LOADING DATA ··················")
+        # print(stats)
+        del self.X
+        del self.Y
+        del self.ids
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+        self.X = torch.tensor(X, device = self.device, dtype=self.storage_dtype)
+        self.Y = torch.tensor(Y, device = self.device, dtype=torch.long)
+        self.ids = torch.tensor(ids, device = self.device, dtype=torch.int)
+        self.low_idx, self.high_idx = self.chunk_bounds(chunk)
+        self.current_chunk = chunk
+        self.load_wait_time += time.time()-start_time
+
+        if self.prefetch:
+            next_chunk = self.following_chunk(chunk)
+            if next_chunk != chunk:
+                self.start_reading(next_chunk)
+
+
+class LRUCachedLCs(Dataset):
+    """Dataset that keeps as many chunks of chunk_size light curves in memory as fit in
+    cache_bytes, evicting the least recently used one when a new chunk doesn't fit.
+    It takes the same arguments as CachedLCs (plus the budget) and can be used wherever
+    CachedLCs or InefficientCachedLCs are, e.g. chunk_size=1 and cache_bytes for
+    data_cache_size objects behaves like InefficientCachedLCs, without reopening the file
+    on every miss. hits, misses and evictions count chunk lookups, see cache_stats.
+
+    Arguments:
+        lc_length : length of light curves to read
+        dataset_file : .hdf5 file in the format written by save_vectors
+        chunk_size : number of objects read at once
+        dataset_length, indices, transform : same as CachedLCs
+        cache_bytes : memory budget for cached chunks, in bytes
+        device : where chunks are kept, host memory by default
+        storage_dtype : type chunks are kept as, see vector_dtype
+    """
+
+    def __init__(self, lc_length, dataset_file, chunk_size=100000, dataset_length=None, indices=None, transform=None,
+        cache_bytes=4*2**30, device=None, storage_dtype=None):
+
+        self.lc_length = lc_length
+        self.device = data_device(device)
+        self.storage_dtype = vector_dtype(storage_dtype)
+
+        self.chunk_size = chunk_size
+        self.dataset_file = dataset_file
+        self.cache_bytes = cache_bytes
+        self.chunks = OrderedDict() #chunk -> (X, Y, ids), least recently used first
+        self.cached_bytes = 0
+        self.h5_file = None
+        self.obs_offsets = None
+
+        self.transform = transform
+        self.dataset_length = dataset_length
+        self.true_dataset_length = None
+        self.indices = indices
+        self.id_index = None
+        self.reset_cache_stats()
+
+        try:
             with h5py.File(self.dataset_file,'r') as f:
-                # current_chunk = np.floor(idx/self.chunk_size)
-                current_chunk = torch.floor(torch.tensor(idx/self.chunk_size,device=self.device))
-                self.low_idx = int(current_chunk*self.chunk_size)
-                high_idx = int((current_chunk+1)*self.chunk_size)
-                self.high_idx =int((current_chunk+1)*self.chunk_size) if high_idx<self.true_dataset_length else int(self.true_dataset_length-1)
-                # stats = torch.cuda.memory_allocated()
-                # print("low : "+str(self.low_idx)+" < "+str(idx)+" high: "+str(self.high_idx))
-                # print("STATS before LOADING DATA ··················")
-                # print(stats)
-                del self.X
-                del self.Y
-                del self.ids
-                torch.cuda.empty_cache()
-        
-                self.X = torch.tensor(f["X"][self.low_idx:self.high_idx,:,0:self.lc_length], device = self.device, dtype=torch.float)
-                self.Y = torch.tensor(f["Y"][self.low_idx:self.high_idx], device = self.device, dtype=torch.long)
-                self.ids = torch.tensor(f["ids"][self.low_idx:self.high_idx], device = self.device, dtype=torch.int)
-                # print(self.X.size())
-                # stats = torch.cuda.memory_allocated()
-                # print("STATS after LOADING DATA ··················")
-                # print(stats)
-                idx = int(idx-self.low_idx)
-                # print(idx)
-                # print(self.X[idx].size())
-                # print(self.Y[idx])
-                sample = self.X[idx], self.Y[idx], self.ids[idx]
+                self.true_dataset_length = len(f["ids"])
+                if self.dataset_length is None:
+                    self.dataset_length = self.true_dataset_length
+                if self.indices is None:
+                    self.dataset_indices = np.arange(0,self.dataset_length)
+        except Exception as e:
+            print(e)
 
+    def __len__(self):
+        return self.dataset_length
+
+    def __getitem__(self, idx):
+        if is_batch_index(idx):
+            return self.get_batch(idx)
+        chunk = int(idx//self.chunk_size)
+        X, Y, ids = self.get_chunk(chunk)
+        idx = int(idx-chunk*self.chunk_size)
+        sample = X[idx].float(), Y[idx], ids[idx]
         if self.transform:
-            # print("hay transform")
-            # print(self.transform)
-            # print(sample)
             return self.transform(sample)
         else:
             return sample
+
+    def __getstate__(self):
+        #h5py handles can't be copied, copies (or worker processes) open their own
+        state = self.__dict__.copy()
+        state["h5_file"] = None
+        return state
+
+    def init_worker(self):
+        #forked workers inherit the parent's handle, they open their own on the first miss
+        self.h5_file = None
+
+    def get_batch(self, idxs):
+        return transformed_batch(upcast(gather_from_chunks(idxs, self.chunk_size, self.get_chunk)), self.transform)
+
+    def chunks_of(self, idxs):
+        return np.asarray(idxs, dtype=np.int64)//self.chunk_size
+
+    def get_chunk(self, chunk):
+        if chunk in self.chunks:
+            self.hits += 1
+            self.chunks.move_to_end(chunk)
+            return self.chunks[chunk]
+
+        self.misses += 1
+        if self.h5_file is None:
+            self.h5_file = h5py.File(self.dataset_file,'r')
+            self.obs_offsets = observation_offsets(self.h5_file)
+        low_idx = chunk*self.chunk_size
+        high_idx = min(low_idx+self.chunk_size, self.true_dataset_length)
+        X = read_vector_rows(self.h5_file, low_idx, high_idx, lc_length=self.lc_length, obs_offsets=self.obs_offsets)
+        chunk_bytes = X.size*self.storage_dtype.itemsize + (high_idx-low_idx)*(8+4)
+        #make room for the new chunk, always keeping it even if it's over budget alone
+        while self.chunks and self.cached_bytes+chunk_bytes > self.cache_bytes:
+            _, evicted = self.chunks.popitem(last=False)
+            self.cached_bytes -= sum(t.element_size()*t.nelement() for t in evicted)
+            self.evictions += 1
+        data = (torch.tensor(X, device = self.device, dtype=self.storage_dtype),
+            torch.tensor(self.h5_file["Y"][low_idx:high_idx], device = self.device, dtype=torch.long),
+            torch.tensor(self.h5_file["ids"][low_idx:high_idx], device = self.device, dtype=torch.int))
+        self.chunks[chunk] = data
+        self.cached_bytes += sum(t.element_size()*t.nelement() for t in data)
+        return data
+
+    def get_by_ids(self, ids):
+        """Returns (X, Y, ids) of the objects with the given ids, in that order, reading
+        only their rows from the file"""
+        if self.id_index is None:
+            self.id_index = read_label_index(self.dataset_file, ["sorted_ids", "id_rows"])
+        return vectors_by_ids(self.dataset_file, ids, self.id_index, self.device, self.lc_length)
+
+    def cache_stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "cached_chunks": len(self.chunks), "cached_bytes": self.cached_bytes}
+
+    def reset_cache_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear_cache(self):
+        self.chunks.clear()
+        self.cached_bytes = 0
+        if self.h5_file is not None:
+            self.h5_file.close()
+            self.h5_file = None
+
+
+class ShardedLCs(Dataset):
+    """Dataset over a sharded dataset (see shard_utils.write_vectors_in_shards): a directory
+    of .hdf5 files described by a manifest, presented as a single indexable dataset. Shards
+    are read whole, when an index falls in them, and the last cache_shards of them are kept
+    in memory. shards selects which of them the dataset holds, so processes (or machines)
+    can each read a disjoint part of the data, e.g. shards=shards_of_rank(n_shards, rank, world_size).
+    Shards are the chunks of the dataset (chunk_size is the manifest's shard_size), so it is
+    sampled like CachedLCs, with ChunkShuffleSampler or ChunkBalancedSampler, which read
+    every shard once per epoch (random sampling would read a shard for almost every batch).
+
+    Arguments:
+        lc_length : length of light curves to read
+        manifest_file : manifest.json of the sharded dataset
+        n_channels : number of channels to read
+        transform : transform applied to every sample
+        shards : list of shard numbers this dataset holds, in order, all by default
+        indices : positions this dataset covers (e.g. a fold), to be sampled from, all by default
+        cache_shards : number of shards kept in memory
+        device : where shards are kept, host memory by default
+        storage_dtype : type shards are kept as, see vector_dtype
+    """
+
+    def __init__(self, lc_length, manifest_file, n_channels=4, transform=None, shards=None, indices=None, cache_shards=2,
+        device=None, storage_dtype=None):
+
+        self.lc_length = lc_length
+        self.manifest_file = manifest_file
+        self.n_channels = n_channels
+        self.transform = transform
+        self.device = data_device(device)
+        self.storage_dtype = vector_dtype(storage_dtype)
+        self.cache_shards = cache_shards
+        self.cached = OrderedDict() #shard -> (X, Y, ids), least recently used first
+        self.id_indexes = {}
+
+        #only the manifest is read here, shards are read on first access
+        self.manifest = read_manifest(self.manifest_file)
+        files = shard_files(self.manifest_file, self.manifest)
+        self.shards = list(range(len(files))) if shards is None else list(shards)
+        self.shard_files = [files[shard] for shard in self.shards]
+        lengths = [self.manifest["shards"][shard]["stop"]-self.manifest["shards"][shard]["start"] for shard in self.shards]
+        self.shard_starts = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        self.chunk_size = self.manifest["shard_size"]
+        #like CachedLCs, positions are not remapped, indices are the ones samplers draw from
+        self.indices = np.arange(self.shard_starts[-1]) if indices is None else np.asarray(indices).astype(np.int64)
+        self.length = len(self.indices)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if is_batch_index(idx):
+            return self.get_batch(idx)
+        shard = int(np.searchsorted(self.shard_starts, idx, side="right")-1)
+        X, Y, ids = self.get_shard(shard)
+        idx = int(idx-self.shard_starts[shard])
+        sample = X[idx].float(), Y[idx], ids[idx]
+        if self.transform:
+            return self.transform(sample)
+        else:
+            return sample
+
+    def get_batch(self, idxs):
+        return transformed_batch(upcast(gather_from_chunks(idxs, None, self.get_shard, self.shard_starts[:-1])),
+            self.transform)
+
+    def chunks_of(self, idxs):
+        return np.searchsorted(self.shard_starts, np.asarray(idxs, dtype=np.int64), side="right")-1
+
+    def get_shard(self, shard):
+        #shard is a position in self.shards
+        if shard in self.cached:
+            self.cached.move_to_end(shard)
+            return self.cached[shard]
+        while self.cached and len(self.cached) >= self.cache_shards:
+            self.cached.popitem(last=False)
+        with h5py.File(self.shard_files[shard],'r') as f:
+            data = (read_vectors(f, self.n_channels, self.lc_length, self.device, self.storage_dtype),
+                torch.tensor(f["Y"][:], device = self.device, dtype=torch.long),
+                torch.tensor(f["ids"][:], device = self.device, dtype=torch.int))
+        self.cached[shard] = data
+        return data
+
+    def init_worker(self):
+        #workers read their shards themselves instead of holding copies of the parent's
+        self.cached = OrderedDict()
+
+    def get_samples_per_class(self, n_classes):
+        #counts come from the manifest, no shard needs to be read (unless only some indices are covered)
+        self.n_classes = n_classes
+        counts = torch.zeros(n_classes)
+        if len(self.indices) != self.shard_starts[-1]:
+            labels = self.get_all_labels()[torch.as_tensor(self.indices)]
+            return torch.bincount(labels.cpu(), minlength=n_classes)[0:n_classes].float()
+        for shard in self.shards:
+            class_counts = self.manifest["shards"][shard]["class_counts"][0:n_classes]
+            counts[0:len(class_counts)] += torch.tensor(class_counts, dtype=torch.float)
+        return counts
+
+    def get_all_labels(self):
+        #only Y of every shard is read
+        labels = []
+        for filename in self.shard_files:
+            with h5py.File(filename,'r') as f:
+                labels.append(f["Y"][:])
+        return torch.tensor(np.concatenate(labels), device = self.device, dtype=torch.long)
+
+    def get_by_ids(self, ids):
+        """Returns (X, Y, ids) of the objects with the given ids, in that order, reading
+        only their rows from the shards that hold them"""
+        ids = np.asarray(ids).astype(np.int64)
+        found = np.zeros(ids.shape, dtype=bool)
+        parts = []
+        positions = []
+        for shard, filename in enumerate(self.shard_files):
+            if shard not in self.id_indexes:
+                self.id_indexes[shard] = read_label_index(filename, ["sorted_ids", "id_rows"])
+            sorted_ids = self.id_indexes[shard]["sorted_ids"]
+            if not len(sorted_ids):
+                continue
+            in_shard = sorted_ids[np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids)-1)] == ids
+            in_shard &= ~found
+            if in_shard.any():
+                parts.append(vectors_by_ids(filename, ids[in_shard], self.id_indexes[shard], self.device, self.lc_length,
+                    self.n_channels))
+                positions.append(np.nonzero(in_shard)[0])
+                found |= in_shard
+        if not found.all():
+            raise ValueError("ids not in dataset: "+str(ids[~found][0:10]))
+        order = torch.as_tensor(np.argsort(np.concatenate(positions)), device=self.device)
+        return tuple(torch.cat(values)[order] for values in zip(*parts))
@@ -10,6 +10,8 @@ import os
 import numpy as np
 import time
 from torch.utils.data import SequentialSampler
+from datasets import batch_loader
+from data_samplers import dataset_labels
 from sklearn.metrics import precision_score, recall_score, precision_recall_fscore_support
 from utils import save_to_stats_pkl_file, load_from_stats_pkl_file, \
     save_statistics, load_statistics, save_classification_results
@@ -33,7 +35,10 @@ class Experiment(nn.Module):
         num_output_classes=11, 
         best_idx=0, 
         verbose=True,
-        cached_dataset=False):
+        cached_dataset=False,
+        num_workers=0,
+        prefetch_factor=2,
+        persistent_workers=False):
 
         super(Experiment, self).__init__()
 
@@ -54,6 +59,9 @@ class Experiment(nn.Module):
         self.model.to(self.device)
         self.model.reset_parameters()
         self.num_output_classes = num_output_classes
+        #batches are read (and decompressed) by num_workers processes while the model trains
+        loader_params = {"num_workers": num_workers, "prefetch_factor": prefetch_factor,
+            "persistent_workers": persistent_workers}
 
 
         if train_data:
@@ -63,9 +71,9 @@ class Experiment(nn.Module):
                 # print(train_sampler)
                 # sampler = SequentialSampler(train_data)
                 # train_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size, sampler=sampler)
-                train_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size, sampler=train_sampler)
+                train_loader = batch_loader(train_data, batch_size, sampler=train_sampler, **loader_params)
             else:
-                train_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size, shuffle=True)
+                train_loader = batch_loader(train_data, batch_size, **loader_params)
             self.train_data = train_loader
 
         else:
@@ -74,18 +82,18 @@ class Experiment(nn.Module):
 
         if val_data:
             if val_sampler is not None:
-                val_loader = torch.utils.data.DataLoader(val_data,batch_size=batch_size,sampler=val_sampler)
+                val_loader = batch_loader(val_data, batch_size, sampler=val_sampler, **loader_params)
             else:
-                 val_loader = torch.utils.data.DataLoader(val_data, batch_size=batch_size, shuffle=True)
+                 val_loader = batch_loader(val_data, batch_size, **loader_params)
             self.val_data = val_loader
         else:
             self.val_data = None
 
         if test_data:
             if test_sampler is not None:
-                test_loader = torch.utils.data.DataLoader(test_data,batch_size=batch_size,sampler=test_sampler)
+                test_loader = batch_loader(test_data, batch_size, sampler=test_sampler, **loader_params)
             else:
-                test_loader = torch.utils.data.DataLoader(test_data,batch_size=batch_size,shuffle=True)
+                test_loader = batch_loader(test_data, batch_size, **loader_params)
             self.test_data = test_loader
         else:
             self.test_data = None
@@ -124,11 +132,10 @@ class Experiment(nn.Module):
             self.starting_epoch = 0
 
     def calculate_balance_weights(self, train_data):
-        counts = torch.zeros(self.num_output_classes)
-        labels = torch.zeros(len(train_data), dtype=torch.long)
-        for i,item in enumerate(train_data):
-            counts[item[1]] +=1 
-            labels[i] = item[1]
+        #labels are read at once, not through __getitem__ (see ChunkBalancedSampler for chunked data)
+        _, _, labels = dataset_labels(train_data)
+        labels = torch.tensor(labels, dtype=torch.long)
+        counts = torch.bincount(labels, minlength=self.num_output_classes).float()
 
         weights_per_class = 1/counts
         weights = weights_per_class[labels]
@@ -137,6 +144,7 @@ class Experiment(nn.Module):
 
 
     def run_train_iter(self, x, y):
+        x, y = x.to(self.device, non_blocking=True), y.to(self.device, non_blocking=True)
         self.train()
         self.optimizer.zero_grad()  # set all weight grads from previous training iters to 0
         out = self.model.forward(x)  # forward the data in the model
@@ -152,6 +160,7 @@ class Experiment(nn.Module):
         return loss,accuracy,f1_score,p,r
 
     def run_evaluation_iter(self, x, y):
+        x, y = x.to(self.device, non_blocking=True), y.to(self.device, non_blocking=True)
         self.eval()  # sets the system to validation mode
         out = self.model.forward(x)  # forward the data in the model
         loss =  self.criterion(out,y)
@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+from preprocess_data_utils import read_objects_in_chunks
 
 class Preprocessor:
     """This class takes as input an csv file that contains light curves, reads 
@@ -11,32 +12,87 @@ class Preprocessor:
     ----------
     input_file: .csv file that contains lightcurves in the following format:
         id,mjd,flux,flux_err, passband
-    chunk_size: number of lightcurves to be read. default is None, which means
-        all light curves are loaded at once.
+    chunk_size: number of rows (light curve points) to be read at a time. default
+        is None, which means all light curves are loaded at once. Chunks always hold
+        complete objects, the rows of an object that is cut by the end of a chunk are
+        carried over to the next one.
     n_passbands: int, optional. Number of passbands in an object. default is 2.
+    seed: int, optional. Seed of the random number generator used by the augmentations.
     -------
+    In chunked mode every operation is applied lazily, chunk by chunk, as the data
+    is iterated with chunks() or written with to_csv(), so memory stays bounded.
     """
-    def __init__(self, input_file, chunk_size=None):
+    def __init__(self, input_file, chunk_size=None, seed=None):
         self.input_file = input_file
+        self.chunk_size = chunk_size
+        self.rng = np.random.default_rng(seed)
+        self.steps = [] #functions applied so far, to stream the data again in chunked mode
         if chunk_size:
-            self.data = pd.read_csv(input_file,memory_map=True, chunksize=chunk_size)
+            self.data = self.read_chunks()
         else:
             self.data = pd.read_csv(input_file,memory_map=True)
 
+    def read_chunks(self):
+        return read_objects_in_chunks(self.input_file, self.chunk_size, "id", memory_map=True)
+
+    def chunks(self):
+        """Returns an iterator over the data as DataFrames of complete objects,
+        with a single DataFrame if the file was not read in chunks.
+        In chunked mode the file is streamed, so it can be iterated only once."""
+        if self.chunk_size:
+            return self.data
+        return iter([self.data])
+
+    def apply(self, function):
+        """Applies function (DataFrame -> DataFrame) to the data, lazily to every chunk in chunked mode"""
+        if self.chunk_size:
+            self.steps.append(function)
+            self.data = map(function, self.data)
+        else:
+            self.data = function(self.data)
+
+    def to_csv(self, output_file):
+        """Writes the (preprocessed) data to output_file, one chunk at a time in chunked mode"""
+        for i, chunk in enumerate(self.chunks()):
+            chunk.to_csv(output_file, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+
     def drop_out_per_lc(self, percent=0.3):
-        id_list = self.data.id.unique()
-        for i in id_list: 
-            query = 'id == {}'.format(i)
-            self.data = self.data.drop(self.data.query(query).sample(frac=1-percent).index)
+        """Keeps a random fraction percent of the points of every light curve, the
+        same amount pandas' sample(frac=1-percent) would drop per object"""
+        def drop_out(data):
+            _, group, sizes = np.unique(data.id.values, return_inverse=True, return_counts=True)
+            n_drop = np.round((1-percent)*sizes).astype(int)
+            #points of every object in random order, the first n_drop of each are dropped
+            order = np.lexsort((self.rng.random(len(data)), group))
+            position = np.empty(len(data), dtype=int)
+            position[order] = np.arange(len(data)) - np.repeat(np.cumsum(sizes)-sizes, sizes)
+            return data[position >= n_drop[group]]
+        self.apply(drop_out)
 
     def add_noise(self):
-        flux_err = self.data.flux_err
-        random_percent = np.random.rand(flux_err.size)
-        self.data.flux_err = flux_err*random_percent
+        def add_noise(data):
+            data = data.copy()
+            random_percent = self.rng.random(len(data))
+            data.flux_err = data.flux_err*random_percent
+            return data
+        self.apply(add_noise)
 
     def normalize_fluxes(self):
-        flux = self.data.flux
-        flux = (flux - flux.min())/(flux.max()-flux.min())
-        self.data.flux = flux
-
-    
\ No newline at end of file
+        """Min-max normalizes all fluxes. In chunked mode min and max are taken in a first
+        pass over the chunks as transformed so far, then the file is streamed again through
+        the same steps (with the random generator reset, so augmentations come out the same)"""
+        if self.chunk_size:
+            state = self.rng.bit_generator.state
+            limits = np.array([[chunk.flux.min(), chunk.flux.max()] for chunk in self.data if len(chunk)])
+            flux_min, flux_max = limits[:, 0].min(), limits[:, 1].max()
+            self.rng.bit_generator.state = state
+            self.data = self.read_chunks()
+            for function in self.steps:
+                self.data = map(function, self.data)
+        else:
+            flux_min, flux_max = self.data.flux.min(), self.data.flux.max()
+        def normalize(data):
+            data = data.copy()
+            data.flux = (data.flux - flux_min)/(flux_max-flux_min)
+            return data
+        self.apply(normalize)
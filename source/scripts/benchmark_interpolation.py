@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import time
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from preprocess_data_utils import *
+
+#compares the per light curve np.interp loop and the per grid point pandas scan used before
+#with batch_interp and batch_nearest_distance on synthetic unstacked light curves
+#(same layout as in create_interpolated_vectors)
+
+length = 128
+max_points = 40
+sizes = [10**4, 10**5, 10**6]
+rng = np.random.default_rng(0)
+
+def synthetic_unstack(n_lcs):
+    n_points = rng.integers(0, max_points+1, n_lcs)
+    time = np.sort(rng.uniform(0, length-1, (n_lcs, max_points)), axis=1)
+    time[:, 0] = np.where(n_points > 1, 0, time[:, 0])
+    flux = rng.normal(20, 2, (n_lcs, max_points))
+    padding = np.arange(max_points) >= n_points[:, np.newaxis]
+    time[padding] = np.nan
+    flux[padding] = np.nan
+    return time, flux
+
+def scan_distance(x, time):
+    time = pd.DataFrame(time)
+    X_void = np.zeros((time.shape[0], x.shape[0]))
+    for i in x:
+        X_void[:, i] = np.abs((time - i)).min(axis = 1).fillna(500)
+    return X_void
+
+def loop_interp(x, time, flux):
+    nan_masks = ~np.isnan(time)
+    X = np.zeros((time.shape[0], x.shape[0]))
+    for i in range(time.shape[0]):
+        if nan_masks[i].any():
+            X[i] = np.interp(x, time[i][nan_masks[i]], flux[i][nan_masks[i]])
+    return X
+
+x = np.arange(length)
+for n_lcs in sizes:
+    time_uns, flux_uns = synthetic_unstack(n_lcs)
+
+    start_time = time.time()
+    X_loop = loop_interp(x, time_uns, flux_uns)
+    loop_time = time.time() - start_time
+
+    start_time = time.time()
+    X_batch = batch_interp(x, time_uns, flux_uns)
+    batch_time = time.time() - start_time
+
+    print("{} lcs: loop {:.3f}s, batched {:.3f}s, speedup x{:.1f}, same output: {}".format(
+        n_lcs, loop_time, batch_time, loop_time/batch_time, np.array_equal(X_loop, X_batch)))
+
+for length in [128, 256, 512]:
+    x = np.arange(length)
+    for n_lcs in sizes[:2]:
+        time_uns, _ = synthetic_unstack(n_lcs)
+        time_uns = time_uns*(length-1)/127
+
+        start_time = time.time()
+        X_scan = scan_distance(x, time_uns)
+        scan_time = time.time() - start_time
+
+        start_time = time.time()
+        X_batch = batch_nearest_distance(x, time_uns)
+        batch_time = time.time() - start_time
+
+        print("length {}, {} lcs: scan {:.3f}s, batched {:.3f}s, speedup x{:.1f}, same output: {}".format(
+            length, n_lcs, scan_time, batch_time, scan_time/batch_time, np.array_equal(X_scan, X_batch)))
@@ -0,0 +1,42 @@
+import numpy as np
+import torch
+from torch.utils.data import Dataset, RandomSampler
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_samplers import CachedRandomSampler, ChunkShuffleSampler, chunk_loads, shuffle_quality
+
+#compares chunk loads per epoch and shuffle quality of the samplers on a class sorted
+#file (written type by type, like the RAPID and simsurvey outputs)
+
+n_objects = 400000
+chunk_size = 50000
+n_classes = 4
+n_epochs = 3
+torch.manual_seed(0)
+
+class SortedIndices(Dataset):
+    def __init__(self, n):
+        self.indices = np.arange(n)
+    def __len__(self):
+        return len(self.indices)
+
+data = SortedIndices(n_objects)
+labels = np.repeat(np.arange(n_classes), n_objects//n_classes)
+n_chunks = int(np.ceil(n_objects/chunk_size))
+samplers = [
+    ("CachedRandomSampler", CachedRandomSampler(data, chunk_size), 1),
+    ("ChunkShuffleSampler", ChunkShuffleSampler(data, chunk_size), 1),
+    ("ChunkShuffleSampler, 2 resident", ChunkShuffleSampler(data, chunk_size, n_resident=2), 2),
+    ("ChunkShuffleSampler, 4 resident", ChunkShuffleSampler(data, chunk_size, n_resident=4), 4),
+    ("RandomSampler", RandomSampler(data), 4)]
+
+for name, sampler, n_resident in samplers:
+    epochs = [list(sampler) for epoch in range(n_epochs)]
+    loads = np.mean([chunk_loads(order, chunk_size, n_resident) for order in epochs])
+    qualities = [shuffle_quality(order, labels) for order in epochs]
+    quality = {key: np.mean([np.abs(q[key]) for q in qualities]) for key in qualities[0]}
+    #does every epoch start with the same classes?
+    first_classes = [int(labels[int(order[0])]) for order in epochs]
+    print("{}: {:.1f} chunk loads per chunk per epoch ({} chunks in memory), |index correlation| {:.3f}, "
+        "batch class distance {:.3f}, classes first seen per epoch {}".format(name, loads/n_chunks, n_resident,
+        quality["index_correlation"], quality["batch_class_distance"], first_classes))
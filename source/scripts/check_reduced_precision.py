@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import torch
+import time
+import os, sys
+import argparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from torch.utils.data import Subset
+from datasets import LCs
+from recurrent_models import GRU1D
+from experiment import Experiment
+from utils import find_best_epoch
+from sklearn.metrics import accuracy_score, precision_recall_fscore_support
+
+#checks that keeping vectors in 16 bits (LCs(storage_dtype=...), or files rewritten with
+#relayout_vectors(dtype="float16")) doesn't change classification results:
+#   1. rounding error of each channel in float16 and bfloat16
+#   2. a GRU is trained on float32 vectors and its best model is tested on the same
+#      objects held in float32, float16 and bfloat16, comparing metrics and predictions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compares classification metrics with vectors kept in 32 and 16 bits")
+    parser.add_argument("dataset_file", help=".h5 file written by save_vectors")
+    parser.add_argument("--exp_dir", default="reduced_precision_check", help="where the model and results are written")
+    parser.add_argument("--dtypes", nargs="+", default=["float16", "bfloat16"], help="16 bit types to check")
+    parser.add_argument("--lc_length", type=int, default=128)
+    parser.add_argument("--n_channels", type=int, default=4)
+    parser.add_argument("--n_classes", type=int, default=4)
+    parser.add_argument("--n_objects", type=int, default=50000, help="objects used, split 60/20/20 in train, val and test")
+    parser.add_argument("--num_epochs", type=int, default=5)
+    parser.add_argument("--batch_size", type=int, default=64)
+    args = parser.parse_args()
+    torch.manual_seed(0)
+
+    datasets = {dtype: LCs(args.lc_length, args.dataset_file, args.n_channels, storage_dtype=dtype).prefetch()
+        for dtype in ["float32"]+args.dtypes}
+    n_objects = min(args.n_objects, len(datasets["float32"]))
+    objects = torch.randperm(len(datasets["float32"]))[0:n_objects].numpy()
+    train, val, test = np.split(objects, [int(0.6*n_objects), int(0.8*n_objects)])
+
+    #1. rounding error, per channel
+    X = datasets["float32"].X
+    for dtype in args.dtypes:
+        error = (datasets[dtype].X.float()-X).abs()
+        relative = error/X.abs().clamp(min=1e-6)
+        print(dtype, "max absolute error per channel", error.amax(dim=(0,2)).numpy(),
+            "max relative error per channel", relative.amax(dim=(0,2)).numpy())
+
+    #2. same model, tested on the vectors in each precision
+    gru_params = {
+        "input_shape": (args.n_channels, args.lc_length),
+        "num_output_classes" : args.n_classes,
+        "hidden_size":100,
+        "batch_size":args.batch_size,
+        "attention":"no_attention",
+        "da":50,
+        "r":1
+        }
+    model = GRU1D(gru_params)
+    experiment = Experiment(model, args.exp_dir,
+        num_epochs=args.num_epochs,
+        batch_size=args.batch_size,
+        train_data=Subset(datasets["float32"], train),
+        val_data=Subset(datasets["float32"], val),
+        num_output_classes=args.n_classes)
+    experiment.run_experiment()
+    best_epoch = find_best_epoch(os.path.join(args.exp_dir, "result_outputs", "summary.csv"))
+
+    for dtype, dataset in datasets.items():
+        start_time = time.time()
+        experiment = Experiment(model, args.exp_dir,
+            batch_size=args.batch_size,
+            test_data=Subset(dataset, test),
+            num_output_classes=args.n_classes,
+            best_idx=best_epoch,
+            verbose=False)
+        experiment.run_experiment("test_results_"+dtype+".csv", "test_summary_"+dtype+".csv")
+        print(dtype, "tested in %s seconds" % (time.time() - start_time))
+
+    logs = os.path.join(args.exp_dir, "result_outputs")
+    results = {dtype: pd.read_csv(os.path.join(logs, "test_results_"+dtype+".csv")).sort_values("id").reset_index(drop=True)
+        for dtype in datasets}
+    #metrics over the whole test set, the summaries average them over (shuffled) batches
+    for dtype, result in results.items():
+        p, r, f1, s = precision_recall_fscore_support(result.true_tags, result.predicted_tags, average='weighted')
+        print("{:<9} acc {:.4f} f1 {:.4f} precision {:.4f} recall {:.4f}".format(dtype,
+            accuracy_score(result.true_tags, result.predicted_tags), f1, p, r))
+    classes = [str(c) for c in range(args.n_classes)]
+    for dtype in args.dtypes:
+        agreement = (results[dtype].predicted_tags == results["float32"].predicted_tags).mean()
+        probability_change = np.abs(results[dtype][classes].values-results["float32"][classes].values).max()
+        print(dtype, "predictions equal to float32: {:.4%}, largest change of a class probability: {:.2e}, "
+            "memory of X: {:.0f} MB instead of {:.0f} MB".format(agreement, probability_change,
+            datasets[dtype].X.nbytes/2**20, X.nbytes/2**20))
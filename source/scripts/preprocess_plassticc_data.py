@@ -6,15 +6,23 @@ import pandas as pd
 import h5py
 import gc
 import os, sys
+import argparse
+from functools import partial
+from itertools import chain
+from multiprocessing import Pool
 import matplotlib.pyplot as plt
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from preprocess_data_utils import *
+from cache_utils import cached_vectors
+from shard_utils import write_vectors_in_shards
 
-plasticc_data_dir = "../../data/plasticc/" 
+plasticc_data_dir = "../../data/plasticc/"
 metadata_file = plasticc_data_dir+"raw/plasticc_test_metadata.csv"
-metadata = pd.read_csv(metadata_file)
 dataset_file = plasticc_data_dir+"plasticc_dataset.h5"
+manifest_file = plasticc_data_dir+"plasticc_shards/manifest.json"
+raw_output_file = plasticc_data_dir+"plasticc_dataset_raw.h5"
+plasticc_sn_tags = [90,67,52,42,62,95]
 
 def sanity_check_plot(original_X, original_Y, original_id, r_X, r_Y, r_id):
     print(original_X)
@@ -36,56 +44,105 @@ def sanity_check_plot(original_X, original_Y, original_id, r_X, r_Y, r_id):
     ax[1].set(title=r_title,xlabel='mjd', ylabel='f')
     plt.show()
 
-#I'm picking only sn and retagging them from 0 to 5
-relevant_metadata = retag_plasticc(metadata)
-sn_ids = relevant_metadata["object_id"].unique()
-with h5py.File(dataset_file, 'a') as hf:
-    for i in np.arange(1,12):
-        data_file = "../../data/plasticc/raw/plasticc_test_set_batch{}.csv".format(i)
-        data_chunk = pd.read_csv(data_file)    
-        
-        #filter data to consider sn only
-        data_chunk = data_chunk[data_chunk["object_id"].isin(sn_ids)]
-        ids = data_chunk["object_id"].unique()
-        #get tags
-        chunk_metadata = relevant_metadata[relevant_metadata["object_id"].isin(ids)]
-        tags = chunk_metadata[["object_id","true_target"]]
-        #convert vectors
-        # print(tags)
-        # print(data_chunk)
-        X,obj_ids,Y = create_interpolated_vectors_plasticc(data_chunk,tags,128)
-        gc.collect()
-        
-        # print(X.shape)
-        # print(obj_ids.size)
-        # print(Y.size)
-
-        #sanity check, is order mantained?
-        random = np.random.randint(0,Y.size-1)
+def checked(datasets, tags):
+    #sanity check, is order mantained?
+    for dataset in datasets:
+        X, obj_ids, Y = dataset["X"], dataset["ids"], dataset["Y"]
+        if Y.size == 0:#parts of a split file may have no objects
+            dataset.pop("raw")
+            yield dataset
+            continue
+        random = np.random.randint(0,Y.size)
         r_id = obj_ids[random]
         r_Y = Y[random]
         r_X = X[random]
-        original_X = data_chunk[data_chunk.object_id == r_id]
-        original_meta = chunk_metadata[chunk_metadata.object_id == r_id]
+        original_X = dataset.pop("raw")
+        original_X = original_X[original_X.object_id == r_id]
+        original_meta = tags[tags.object_id == r_id]
         original_id = original_meta.object_id.values
         original_Y = original_meta.true_target.values
         sanity_check_plot(original_X, original_Y, original_id, r_X, r_Y, r_id)
+        yield dataset
 
-        # write to file
-        if i == 1: #create dataset if it's the 1st chunk
-            hf.create_dataset('X', data=X, compression="gzip", chunks=True, maxshape=(None,None,None)) 
-            hf.create_dataset('Y', data=Y, compression="gzip", chunks=True, maxshape=(None,)) 
-            hf.create_dataset('ids', data=obj_ids, compression="gzip", chunks=True, maxshape=(None,)) 
-        else: #resize the dataset otherwise
-            hf["X"].resize((hf["X"].shape[0] + X.shape[0]), axis = 0)
-            hf["X"][-X.shape[0]:] = X
+def vectorize_job(job, **kwargs):
+    data_file, part, part_rows = job
+    dataset = vectorize_plasticc_file(data_file, part=part, part_rows=part_rows, **kwargs)
+    gc.collect()
+    return dataset
 
-            hf["Y"].resize((hf["Y"].shape[0] + Y.shape[0]), axis = 0)
-            hf["Y"][-Y.shape[0]:] = Y
+def raw_job(job, **kwargs):
+    #raw light curves of one part, one dataset per chunk read
+    data_file, part, part_rows = job
+    datasets = list(stream_plasticc_file(data_file, part=part, part_rows=part_rows, raw=True, **kwargs))
+    gc.collect()
+    return datasets
 
-            hf["ids"].resize((hf["ids"].shape[0] + obj_ids.shape[0]), axis = 0)
-            hf["ids"][-obj_ids.shape[0]:] = obj_ids
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="vectorizes PLAsTiCC batch files into "+dataset_file)
+    parser.add_argument("--n_workers", type=int, default=1, help="number of worker processes, 1 runs serially")
+    parser.add_argument("--n_parts", type=int, default=1, help="parts each batch file is split into, by object_id")
+    parser.add_argument("--lc_length", type=int, default=128)
+    parser.add_argument("--chunk_size", type=int, default=None, help="rows read at a time, by default files are read whole")
+    parser.add_argument("--plot", action="store_true", help="show a (blocking) sanity check plot per part, the cache is not used")
+    parser.add_argument("--cache_dir", default=".preprocessing_cache", help="where vectors of each part are kept between runs")
+    parser.add_argument("--compact", action="store_true", help="store observation times instead of distance channels, "
+        "which are computed when the file is read (about half the size)")
+    parser.add_argument("--shard_size", type=int, default=None, help="write shards of this many objects and a manifest "
+        "to "+manifest_file+" (read with ShardedLCs) instead of a single file")
+    parser.add_argument("--raw", action="store_true", help="store raw light curves in "+raw_output_file+
+        " instead, to be interpolated at any length when loaded (datasets.RawLCs)")
+    args = parser.parse_args()
+    output_file = manifest_file if args.shard_size else dataset_file
 
+    #I'm picking only sn and retagging them from 0 to 5
+    metadata = pd.read_csv(metadata_file)
+    relevant_metadata = retag_plasticc(metadata, plasticc_sn_tags)
+    tags = relevant_metadata[["object_id","true_target"]]
+    del metadata
 
+    #workers vectorize in parallel, this process is the only one writing, in job order
+    pool = Pool(args.n_workers) if args.n_workers > 1 else None
 
+    #one job per part of each batch file, results are written in this order. Files split in
+    #parts have their id column read once to find the rows of each part, so parts don't read
+    #the whole file each
+    data_files = ["../../data/plasticc/raw/plasticc_test_set_batch{}.csv".format(i) for i in np.arange(1,12)]
+    if args.n_parts > 1:
+        find_parts = partial(part_row_ranges, tags=tags, n_parts=args.n_parts, chunk_size=args.chunk_size or 1000000)
+        file_parts = (pool.map if pool else map)(find_parts, data_files)
+    else:
+        file_parts = [[None] for data_file in data_files]
+    jobs = [(data_file, part, part_rows) for data_file, parts in zip(data_files, file_parts)
+        for part, part_rows in enumerate(parts)]
+    params = dict(tags=tags, length=args.lc_length, n_parts=args.n_parts, keep_raw=args.plot, chunk_size=args.chunk_size,
+        compact=args.compact)
 
+    if args.raw:
+        #as in the simsurvey script, the raw file is not cached, it is written again whole
+        raw_params = dict(tags=tags, n_parts=args.n_parts, chunk_size=args.chunk_size)
+        datasets = (pool.imap if pool else map)(partial(raw_job, **raw_params), jobs)
+        n = write_raw_lcs_in_order(chain.from_iterable(datasets), raw_output_file)
+        print("wrote {} objects to {}".format(n, raw_output_file))
+    elif args.plot:
+        #serially, chunks are written as they are streamed so memory stays bounded
+        if pool:
+            datasets = pool.imap(partial(vectorize_job, **params), jobs)
+        else:
+            datasets = chain.from_iterable(stream_plasticc_file(data_file, part=part, part_rows=part_rows, **params)
+                for data_file, part, part_rows in jobs)
+        if args.shard_size:
+            n = write_vectors_in_shards(checked(datasets, tags), manifest_file, args.shard_size)
+        else:
+            n = write_vectors_in_order(checked(datasets, tags), dataset_file)
+        print("wrote {} objects to {}".format(n, output_file))
+    else:
+        #only parts whose batch file, metadata or code changed since the last run are vectorized again
+        inputs = [[data_file, metadata_file] for data_file, part, part_rows in jobs]
+        n = cached_vectors(jobs, partial(vectorize_job, **params), output_file, inputs,
+            params=dict(length=args.lc_length, n_parts=args.n_parts, sn_tags=plasticc_sn_tags, compact=args.compact),
+            code=[stream_plasticc_file, create_interpolated_vectors, create_compact_vectors],
+            map_function=pool.imap if pool else map, cache_dir=args.cache_dir, shard_size=args.shard_size)
+        print("vectorized {} of {} parts into {}".format(n, len(jobs), output_file))
+    if pool:
+        pool.close()
+        pool.join()
@@ -1,94 +1,120 @@
 from astropy.io import fits
 from astropy.table import Table
 import os, sys
+import argparse
+from multiprocessing import Pool
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 from preprocess_data_utils import *
+from cache_utils import cached_vectors
 
 data_dir = "../../data/rapid_data/ZTF_20190512/"
 models = ["01","02","03","12","13","14","41","43","51","60","61","62","63","64"]
 tags = {"01":0,"02":2,"03":1,"12":2,"13":1,"14":2,"41":3,"43":4,"51":5,"60":6,"61":7,"62":8,"63":9,"64":10}
+output_file = "rapid_data.h5"
+raw_output_file = "rapid_data_raw.h5"
 
-for i,model in enumerate(models):
-    print("model "+model)
-    c=0
-    data = []
-    labels = []
-    ids = []
+def decode_strings(column):
+    """FITS string columns come as space padded byte strings, decode and strip them all at once"""
+    column = np.asarray(column)
+    if column.dtype.kind == "S":
+        column = np.char.decode(column, "ascii")
+    return np.char.strip(column.astype(str))
 
-    for f in np.arange(1,41):
-        print("file "+str(f)+"/40")
-        f_str = str(f) if f >=10 else "0"+str(f)
-        filename = data_dir+"ZTF_MSIP_MODEL{}/ZTF_MSIP_NONIaMODEL0-00{}_PHOT.FITS".format(model,f_str)
+def fits_filename(model, f):
+    f_str = str(f) if f >=10 else "0"+str(f)
+    return data_dir+"ZTF_MSIP_MODEL{}/ZTF_MSIP_NONIaMODEL0-00{}_PHOT.FITS".format(model,f_str)
 
-        dat = Table.read(filename, format='fits')
-        df = dat.to_pandas()
-        # print(df.groupby(["FIELD"]).count())
-        df["FIELD"]=df["FIELD"].apply(lambda x: str(x).strip()[2:-1].strip())#getting rid of formatting error
-        df["FLT"]=df["FLT"].apply(lambda x: str(x).strip()[2:-1].strip())#getting rid of formatting error
+def read_file(job):
+    """Reads the FITS file f of a model, with fluxes as magnitudes and only the objects
+    observed in both bands. Returns its points and tags sorted by id, None if no object is left"""
+    model, f = job
+    filename = fits_filename(model, f)
 
-        # transform fluxes to magnitudes
-        df = df[df['FLUXCAL']>=0]
-        df['flux'] = flux_to_abmag(df["FLUXCAL"],zp=df["ZEROPT"])
-        # make sure there are points in both bands
-        group_by_id_band = df.groupby(['FIELD','FLT'])['MJD'].agg(['count']).rename(columns = lambda x : 'time_' + x).reset_index()
-        # print(group_by_id_band.head())
-        group_by_id_band = group_by_id_band.groupby(['FIELD']).count()
-        # print(group_by_id_band.head())
-        ids_enough_point_count = group_by_id_band[group_by_id_band.time_count==2]
-        # print(ids_enough_point_count.head())
-        usable_ids = list(set(ids_enough_point_count.index.values))
-        df = df[df.FIELD.isin(usable_ids)]
-        # print(df.groupby(["FIELD"]).count())
-        # convert bands to the code's sim uses (r=0, g=1)
-        df.loc[df.FLT=="r",'FLT'] = 0
-        df.loc[df.FLT=="g",'FLT'] = 1
-        # rename columns to suit preprocess_data_utils
-        df = df.rename(columns = {"FIELD":"id","MJD":"time","FLT":"band"})
-        
-        df_tag = df_tags(df, tags[model])
+    dat = Table.read(filename, format='fits')
+    #getting rid of formatting error
+    dat["FIELD"] = decode_strings(dat["FIELD"])
+    dat["FLT"] = decode_strings(dat["FLT"])
+    df = dat.to_pandas()
 
-        # print(df_tag)
-        # print(df.head())
+    # transform fluxes to magnitudes
+    df = df[df['FLUXCAL']>=0].copy()
+    df['flux'] = flux_to_abmag(df["FLUXCAL"],zp=df["ZEROPT"])
+    # only r and g points are used
+    df = df[df.FLT.isin(["r","g"])]
+    # make sure there are points in both bands
+    group_by_id_band = df.groupby(['FIELD','FLT'])['MJD'].agg(['count']).rename(columns = lambda x : 'time_' + x).reset_index()
+    group_by_id_band = group_by_id_band.groupby(['FIELD']).count()
+    ids_enough_point_count = group_by_id_band[group_by_id_band.time_count==2]
+    usable_ids = list(set(ids_enough_point_count.index.values))
+    df = df[df.FIELD.isin(usable_ids)]
+    if df.empty:
+        return None
+    # convert bands to the code's sim uses (r=0, g=1)
+    df['FLT'] = df.FLT.map({"r":0, "g":1})
+    # rename columns to suit preprocess_data_utils, FIELD ids are numeric strings
+    df = df.rename(columns = {"FIELD":"id","MJD":"time","FLT":"band"})
+    df['id'] = df.id.astype(np.int64)
 
-        # print("shape of df ", df.groupby("id").count().shape[0])
-        # print("shape of tags ",df_tag.shape)
-        X,id,Y = create_interpolated_vectors(df,df_tag,128,n_channels=4)
-        int_ids = np.array(list(map(int, id))) 
-        # print("shape of vectors", X.shape)
-        # print("shape of tags", Y.shape)
-        c+=len(id)
-        # print(c)
-        if len(data) == 0:
-            data = X
-            labels = Y
-            ids = int_ids
-        else:
-            data = np.concatenate((data, X))
-            labels = np.concatenate((labels, Y))
-            ids = np.concatenate((ids, int_ids))
+    #vectors come out sorted by id, tags have to follow the same order
+    df_tag = df_tags(df, tags[model]).sort_values("id")
+    return df, df_tag
 
-        # print("shape of concat vectors", data.shape)
-        # print("shape of concat tags", labels.shape)
+def vectorize_file(job):
+    """Reads the FITS file f of a model and returns its objects as interpolated vectors"""
+    data = read_file(job)
+    if data is None:
+        return {'X':np.zeros((0,4,128),dtype=np.float32), 'Y':np.zeros(0,dtype=np.int64), 'ids':np.zeros(0,dtype=np.int64)}
+    df, df_tag = data
+    X,id,Y = create_interpolated_vectors(df,df_tag,128)
+    return {'X':X, 'Y':Y, 'ids':np.asarray(id).astype(np.int64)}
 
+def raw_file(job):
+    """Reads the FITS file f of a model and returns the raw light curves of its objects (see raw_lcs)"""
+    data = read_file(job)
+    if data is None:
+        empty = np.zeros(0, dtype=np.int64)
+        data = (pd.DataFrame({"id":empty, "time":np.zeros(0), "band":empty, "flux":np.zeros(0)}),
+            pd.DataFrame({"id":empty, "type":empty}))
+    df, df_tag = data
+    return raw_lcs(df, df_tag)
 
-    dataset = {
-        'X':data,
-        'Y':labels,
-        'ids':ids
-    }
+def counted(datasets, jobs, counts):
+    for (model, f), dataset in zip(jobs, datasets):
+        print("model "+model+", file "+str(f)+"/40")
+        counts[model] = counts.get(model, 0) + len(dataset["ids"])
+        if f == 40:
+            print(counts)
+        yield dataset
 
-    if i == 0:
-        save_vectors(dataset,"rapid_data.h5")
-        counts = {model:c}
-        print(counts)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="vectorizes RAPID FITS files into "+output_file)
+    parser.add_argument("--n_workers", type=int, default=1, help="number of worker processes, 1 runs serially")
+    parser.add_argument("--cache_dir", default=".preprocessing_cache", help="where vectors of each file are kept between runs")
+    parser.add_argument("--raw", action="store_true", help="store raw light curves in "+raw_output_file+
+        " instead, to be interpolated at any length when loaded (datasets.RawLCs)")
+    args = parser.parse_args()
 
-    else :
-        append_vectors(dataset,"rapid_data.h5")
-        counts[model]=c
-        print(counts)
+    #files are vectorized in parallel and streamed into the output file in this order
+    #only files that changed since the last run (or with changed code) are vectorized again
+    jobs = [(model, int(f)) for model in models for f in np.arange(1,41)]
+    inputs = [[fits_filename(model, f)] for model, f in jobs]
+    counts = {}
+    pool = Pool(args.n_workers) if args.n_workers > 1 else None
+    if args.raw:
+        #as in the simsurvey script, the raw file is not cached, it is written again whole
+        datasets = pool.imap(raw_file, jobs) if pool else map(raw_file, jobs)
+        write_raw_lcs_in_order(counted(datasets, jobs, counts), raw_output_file)
+    else:
+        cached_vectors(jobs, vectorize_file, output_file, inputs, params={"length":128, "tags":tags},
+            code=[read_file, vectorize_file, create_interpolated_vectors],
+            transform=lambda datasets: counted(datasets, jobs, counts),
+            map_function=pool.imap if pool else map, cache_dir=args.cache_dir)
+    if pool:
+        pool.close()
+        pool.join()
 
 # header_filname = "../../data/rapid_data/ZTF_20190512/ZTF_MSIP_MODEL01/ZTF_MSIP_NONIaMODEL0-0001_HEAD.FITS"
 # def plot_light_curve():
@@ -7,84 +7,128 @@ import h5py
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from preprocess_data_utils import *
+from cache_utils import cache_key, is_up_to_date, mark_up_to_date, load_digests, save_digests
 import matplotlib.pyplot as plt
 #load real light curves
 
-def construct_vectors(sns,tags,filename,meta_file=None,days_obs=30,point_count=3):
+def band_matrices(lcs, obids, band):
+    """Returns time and flux of the points of one band as 2D arrays, one row per object
+    in obids (nan padded), keeping the order in which points appear in lcs"""
+    lc = lcs[lcs.band == band]
+    row = pd.Index(obids).get_indexer(lc.id)
+    order = np.argsort(row, kind="stable")
+    order = order[row[order] >= 0]
+    row = row[order]
+    counts = np.bincount(row, minlength=len(obids))
+    col = np.arange(row.size) - np.repeat(np.cumsum(counts)-counts, counts)
+    time = np.full((len(obids), max(counts.max(initial=0), 1)), np.nan)
+    flux = np.full(time.shape, np.nan)
+    time[row, col] = lc.time.values[order]
+    flux[row, col] = lc.flux.values[order]
+    return time, flux
+
+def construct_vectors_per_count(sns,tags,filenames,point_counts,meta_files=None,days_obs=30):
+    """Builds the vectors of all the objects that have more than days_obs days of observations
+    once, and writes one dataset per point_count threshold (at least that many points in both
+    bands) as a subset of them.
+    Parameters
+    ----------
+    sns: pandas DataFrame, light curve points in Lasair format (id, time, flux, band)
+    tags: pandas DataFrame, metadata with objid, id and tag columns
+    filenames: list of str, .h5 output file for each threshold
+    point_counts: list of int, minimum number of points per band
+    meta_files: list of str, optional. .csv file where the metadata of each subset is written
+    days_obs: int, optional. Minimum number of days between first and last observation
+    """
     print('\n')
     print(len(sns))
 
     sns_cp = sns.copy()
     group_by_id = sns_cp.groupby(['id'])['time'].agg(['min', 'max']).rename(columns = lambda x : 'time_' + x).reset_index()
     group_by_id["time_diff"]=group_by_id.time_max-group_by_id.time_min
-    
+
     #ensure there is at least 30 days of obsevations
     ids_enough_obs=group_by_id[group_by_id.time_diff>days_obs].id.values
     group_by_id = group_by_id[group_by_id.id.isin(ids_enough_obs)]
     sn_enough=sns[sns.id.isin(ids_enough_obs)]
 
-    #ensure there is at least 3 points per band
+    #count points per band, objects need two bands with at least point_count points
     group_by_id_band = sn_enough.groupby(['id','band'])['time'].agg(['count']).rename(columns = lambda x : 'time_' + x).reset_index()
-    #drop all lcs that have less than 3 points
-    at_least_3 = group_by_id_band[group_by_id_band.time_count>=point_count]
-    #drop also their companion band
-    band_counts = at_least_3.groupby(['id']).count().reset_index()
-    band_counts = band_counts[band_counts.time_count==2]
-    sn_enough=sn_enough[sn_enough.id.isin(band_counts.id)]
-    tags_enough = tags[tags.objid.isin(band_counts.id)]
+    enough_per_count = [group_by_id_band[group_by_id_band.time_count>=c].groupby('id').size()==2 for c in point_counts]
+    enough_per_count = [enough[enough].index for enough in enough_per_count]
+    ids_any_count = enough_per_count[0]
+    for enough in enough_per_count[1:]:
+        ids_any_count = ids_any_count.union(enough)
+
+    sn_enough=sn_enough[sn_enough.id.isin(ids_any_count)].copy()
+    tags_enough = tags[tags.objid.isin(ids_any_count)]
 
     #coonvert bands to the code's sim uses (r=0, g=1)
     #instead of lasair's (g=1, r=2)
     sn_enough.loc[sn_enough.band==2,'band'] = 0
 
-    count = 0
+    #the grid of every object goes from its 1st to its last observation in ~1 day steps,
+    #built like np.arange(lc_start,lc_stop+1,lc_step) would
     max_length = group_by_id.time_diff.max()
     max_scaled_length = int(np.ceil(128*max_length/128))
+    obids = tags_enough.objid.unique()
+    lcs_info = group_by_id.set_index('id').loc[obids]
+    lc_length = lcs_info.time_diff.values
+    lc_start = lcs_info.time_min.values
+    lc_stop = lcs_info.time_max.values
+    scaled_lc_length = np.ceil(128*lc_length/128).astype(int)
+    lc_step = lc_length/scaled_lc_length
+    n_steps = np.ceil(((lc_stop+1)-lc_start)/lc_step).astype(int)
+    steps = np.arange(max_scaled_length+2)
+    new_x = lc_start[:, np.newaxis] + steps*((lc_start+lc_step)-lc_start)[:, np.newaxis]
+    new_x[steps >= n_steps[:, np.newaxis]] = np.nan
+    #distances are only measured up to scaled_lc_length
+    void_x = np.where(steps <= scaled_lc_length[:, np.newaxis], new_x, np.nan)
+
     X=np.zeros((tags_enough.shape[0],4,max_scaled_length+2))
+    for channel, band in enumerate([0, 1]):
+        time, flux = band_matrices(sn_enough, obids, band)
+        X[0:len(obids),channel] = np.nan_to_num(batch_interp(new_x, time, flux), nan=0)
+        X[0:len(obids),channel+2] = np.nan_to_num(batch_nearest_distance(void_x, time), nan=0)
 
-    obids = tags_enough.objid.unique()
-    for n,objid in enumerate(obids):
-        lc = sn_enough[sn_enough.id == objid]
-        lc_r = lc[lc.band == 0] 
-        lc_g = lc[lc.band == 1]
-        # print(objid)
-        lc_length = group_by_id.loc[group_by_id.id == objid, 'time_diff'].values[0]
-        lc_start = group_by_id.loc[group_by_id.id == objid, 'time_min'].values[0]
-        lc_stop = group_by_id.loc[group_by_id.id == objid, 'time_max'].values[0]
-        scaled_lc_length=int(np.ceil(128*lc_length/128))
-        lc_step = lc_length/scaled_lc_length
-        new_x = np.arange(lc_start,lc_stop+1,lc_step)
-        X[n,0,0:scaled_lc_length+2] = np.interp(new_x,lc_r.time, lc_r.flux)
-        X[n,1,0:scaled_lc_length+2] = np.interp(new_x,lc_g.time, lc_g.flux)
+    #every threshold is a subset of the rows computed above
+    for n,(enough, filename) in enumerate(zip(enough_per_count, filenames)):
+        in_subset = tags_enough.objid.isin(enough).values
+        subset_tags = tags_enough[in_subset]
+        print(filename)
+        print(X[in_subset].shape)
+        print(subset_tags.id.unique().shape)
+        print(subset_tags.tag.values.shape)
 
-        for i in range(scaled_lc_length+1):
-            X[n,2,i] = np.abs(lc_r.time.values - new_x[i]).min()
-            X[n,3,i] = np.abs(lc_g.time.values - new_x[i]).min()
-            
-    print(X.shape)
-    print(tags_enough.id.unique().shape)
-    print(tags_enough.tag.values.shape)
+        dataset = {
+        'X':X[in_subset],
+        'Y':subset_tags.tag.values,
+        'ids':subset_tags.id.unique()
+        }
 
-    dataset = {
-    'X':X,
-    'Y':tags_enough.tag.values,
-    'ids':tags_enough.id.unique()
-    }
-    # print(dataset)
+        if meta_files:
+            subset_tags.to_csv(meta_files[n])
+        save_vectors(dataset,filename)
 
-    if metafile:
-        tags_enough.to_csv(meta_file)
-    save_vectors(dataset,filename)
+def construct_vectors(sns,tags,filename,meta_file=None,days_obs=30,point_count=3):
+    construct_vectors_per_count(sns,tags,[filename],[point_count],[meta_file] if meta_file else None,days_obs)
 
 
 data_dir="../../data/testing/27-06-2020-sns/"
 filename = "data_4_types.csv"
-data = pd.read_csv(data_dir+filename)
 metafile = "metadata_4_types.csv"
-metadata = pd.read_csv(data_dir+metafile)
-# print(data)
 counts = [3,5,10,15,20,25,30,35,40]
-for c in counts:
-    filename = "real_data_30do_count{}.h5".format(c)
-    print(filename)
-    construct_vectors(data,metadata,filename,point_count=c)
\ No newline at end of file
+filenames = ["real_data_30do_count{}.h5".format(c) for c in counts]
+#only thresholds whose file is missing or was built from other data/code are built again
+digests = load_digests()
+keys = [cache_key([data_dir+filename, data_dir+metafile], {"days_obs":30, "point_count":c},
+    code=[construct_vectors_per_count, batch_interp], digests=digests) for c in counts]
+save_digests(digests)
+stale = [n for n, key in enumerate(keys) if not is_up_to_date(filenames[n], key)]
+if stale:
+    data = pd.read_csv(data_dir+filename)
+    metadata = pd.read_csv(data_dir+metafile)
+    # print(data)
+    construct_vectors_per_count(data,metadata,[filenames[n] for n in stale],[counts[n] for n in stale])
+    for n in stale:
+        mark_up_to_date(filenames[n], keys[n])
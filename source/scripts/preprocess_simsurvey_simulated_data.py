@@ -5,73 +5,110 @@ import torch.nn as nn
 import time
 import h5py
 import os, sys
+import argparse
+from multiprocessing import Pool
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from preprocess_data_utils import *
+from cache_utils import cached_vectors
 
 train_data_dir = "../../data/training/raw/"
 types = np.arange(4)
 type_names = ["Ia_salt2","Ibc_nugent","IIn_nugent","IIP_nugent"]
+output_file = "unbalanced_dataset_m_realzp_128_small.h5"
+raw_output_file = "unbalanced_dataset_m_realzp_raw_small.h5"
+compact_output_file = "unbalanced_dataset_m_realzp_128_small_compact.h5"
 
-id_count = 0
+def load_pickle(job):
+    """Reads one simsurvey .pkl, with fluxes as magnitudes and only the objects
+    observed in both bands. Returns the light curves, their tags and the number
+    of ids used (last usable id + 1), so ids can be shifted when files are merged"""
+    i, type = job
+    #load snIa simulated lightcurves
+    file_str = train_data_dir+"lcs_"+type_names[type]+"_00000"+str(i)+".pkl"
+    sns = pkl_to_df(file_str)
 
-data = []
-tags = []
-ids = []
+    #this here is to transform to magnitudes
+    #first drop all negative sort_values
+    sns = sns[sns['flux']>=0].copy()
+    #now do transform
+    sns.loc[sns.band==0,'flux'] = flux_to_abmag(sns.loc[sns.band==0, 'flux'],zp=26.275)#26.275 ?? esto está mal
+    sns.loc[sns.band==1, 'flux'] = flux_to_abmag(sns.loc[sns.band==1, 'flux'],zp=26.325)#26.325
+    #now ensure that all objects have two bands
+    group_by_id_band = sns.groupby(['id','band'])['time'].agg(['count']).rename(columns = lambda x : 'time_' + x).reset_index()
+    group_by_id_band = group_by_id_band.groupby(['id']).count()
+    ids_enough_point_count = group_by_id_band[group_by_id_band.time_count==2]
+    usable_ids = list(set(ids_enough_point_count.index.values))
+    sns = sns[sns.id.isin(usable_ids)]
 
-for i in np.arange(4): #half the files
-    for type in types:
-        print("building vectors for file ",str(i), " of type ",str(type))
-        #load snIa simulated lightcurves
-        file_str = train_data_dir+"lcs_"+type_names[type]+"_00000"+str(i)+".pkl"
-        sns = pkl_to_df(file_str, id_count)
+    # t = type if type < 3 else 2
+    # t = 2 if type == 3 else type
+    # sns_tags = df_tags(sns, t)
+    sns_tags = df_tags(sns, type)
 
-        #this here is to transform to magnitudes
-        #first drop all negative sort_values
-        # print(sns.head())
-        sns = sns[sns['flux']>=0]
-        #now do transform
-        # print(sns.head())
-        sns.loc[sns.band==0,'flux'] = flux_to_abmag(sns.loc[sns.band==0, 'flux'],zp=26.275)#26.275 ?? esto está mal
-        sns.loc[sns.band==1, 'flux'] = flux_to_abmag(sns.loc[sns.band==1, 'flux'],zp=26.325)#26.325
-        #now ensure that all objects have two bands
-        group_by_id_band = sns.groupby(['id','band'])['time'].agg(['count']).rename(columns = lambda x : 'time_' + x).reset_index()
-        group_by_id_band = group_by_id_band.groupby(['id']).count()
-        ids_enough_point_count = group_by_id_band[group_by_id_band.time_count==2]
-        usable_ids = list(set(ids_enough_point_count.index.values))
-        sns = sns[sns.id.isin(usable_ids)]
-        # print(sns.shape)
+    print("shape of df ", sns.shape)
+    print("shape of tags ",sns_tags.shape)
+    return sns, sns_tags, int(sns_tags.id.tail(1).values[0]+1)
 
-        # t = type if type < 3 else 2 
-        # t = 2 if type == 3 else type 
-        # sns_tags = df_tags(sns, t)
-        sns_tags = df_tags(sns, type)
-        id_count = int(sns_tags.id.tail(1).values+1)
+def vectorize_pickle(job):
+    """Builds the vectors of one simsurvey .pkl, with ids starting at 0"""
+    print("building vectors for file ",str(job[0]), " of type ",str(job[1]))
+    sns, sns_tags, n_ids = load_pickle(job)
+    X,id,Y = create_interpolated_vectors(sns,sns_tags,128)
+    print("shape of vectors", X.shape)
+    print("shape of tags", Y.shape)
+    return {'X':X, 'Y':Y, 'ids':id, 'n_ids':n_ids}
 
-        print("shape of df ", sns.shape)
-        print("shape of tags ",sns_tags.shape)
-        X,id,Y = create_interpolated_vectors(sns,sns_tags,128,n_channels=4)
-        print("shape of vectors", X.shape)
-        print("shape of tags", Y.shape)
-        if len(data) == 0:
-            data = X
-            tags = Y
-            ids = id
-        else:
-            data = np.concatenate((data, X))
-            tags = np.concatenate((tags, Y))
-            ids = np.concatenate((ids, id))
+def compact_pickle(job):
+    """Builds the vectors of one simsurvey .pkl without distance channels (see create_compact_vectors)"""
+    print("building compact vectors for file ",str(job[0]), " of type ",str(job[1]))
+    sns, sns_tags, n_ids = load_pickle(job)
+    dataset = create_compact_vectors(sns,sns_tags,128)
+    dataset['n_ids'] = n_ids
+    return dataset
 
-        print("shape of concat vectors", data.shape)
-        print("shape of concat tags", tags.shape)
-#total_sns = pd.concat(data,ignore_index=True)
-#total_tags = pd.concat(tags, ignore_index=True)
-#print("total shape of vectors", total_sns.shape)
-#print("building vectors for file", total_tags.shape)
+def raw_pickle(job):
+    """Keeps the raw light curves of one simsurvey .pkl, with ids starting at 0"""
+    print("storing raw light curves for file ",str(job[0]), " of type ",str(job[1]))
+    sns, sns_tags, n_ids = load_pickle(job)
+    dataset = raw_lcs(sns, sns_tags)
+    dataset['n_ids'] = n_ids
+    return dataset
 
-dataset = {
-    'X':data,
-    'Y':tags,
-    'ids':ids
-}
+def renumbered(datasets):
+    #each file's ids start where the previous file's ended
+    id_count = 0
+    for dataset in datasets:
+        dataset['ids'] = dataset['ids'] + id_count
+        id_count += dataset.pop('n_ids')
+        yield dataset
 
-save_vectors(dataset,"unbalanced_dataset_m_realzp_128_small.h5")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="vectorizes simsurvey .pkl files into "+output_file)
+    parser.add_argument("--n_workers", type=int, default=1, help="number of worker processes, 1 runs serially")
+    parser.add_argument("--cache_dir", default=".preprocessing_cache", help="where vectors of each pickle are kept between runs")
+    parser.add_argument("--raw", action="store_true", help="store raw light curves in "+raw_output_file+
+        " instead, to be interpolated at any length when loaded (datasets.RawLCs)")
+    parser.add_argument("--compact", action="store_true", help="store observation times instead of distance channels "
+        "in "+compact_output_file+", they are computed when the file is read")
+    args = parser.parse_args()
+
+    #pickles are converted concurrently and merged into one file in this order
+    #only pickles that changed since the last run (or with changed code) are converted again
+    jobs = [(int(i), int(type)) for i in np.arange(4) for type in types] #half the files
+    inputs = [[train_data_dir+"lcs_"+type_names[type]+"_00000"+str(i)+".pkl"] for i, type in jobs]
+    pool = Pool(args.n_workers) if args.n_workers > 1 else None
+    if args.raw:
+        datasets = pool.imap(raw_pickle, jobs) if pool else map(raw_pickle, jobs)
+        n = write_raw_lcs_in_order(renumbered(datasets), raw_output_file)
+        print("total number of objects", n)
+    elif args.compact:
+        n = cached_vectors(jobs, compact_pickle, compact_output_file, inputs, params={"length":128},
+            code=[pkl_to_df], transform=renumbered, map_function=pool.imap if pool else map, cache_dir=args.cache_dir)
+        print("number of pickles converted", n)
+    else:
+        n = cached_vectors(jobs, vectorize_pickle, output_file, inputs, params={"length":128},
+            code=[pkl_to_df], transform=renumbered, map_function=pool.imap if pool else map, cache_dir=args.cache_dir)
+        print("number of pickles converted", n)
+    if pool:
+        pool.close()
+        pool.join()
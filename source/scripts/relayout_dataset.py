@@ -0,0 +1,105 @@
+import numpy as np
+import h5py
+import time
+import os, sys
+import argparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from preprocess_data_utils import *
+
+#rewrites a vectors file (as written by save_vectors) with other chunk shapes and codecs and
+#reports how fast each layout is read with the access patterns of the loaders:
+#   LCs reads the whole file at once, X[:, 0:n_channels, 0:lc_length]
+#   CachedLCs and LRUCachedLCs read contiguous ranges of chunk_size rows
+#   get_by_ids reads scattered rows (read_rows)
+#with --codecs contiguous it converts a file to be used with MemmapLCs
+
+def timed(function, repeats=1):
+    #best of repeats, in seconds
+    times = []
+    for r in range(repeats):
+        start_time = time.time()
+        function()
+        times.append(time.time()-start_time)
+    return min(times)
+
+def read_throughput(inputFile, n_channels, lc_length, chunk_size, n_ids, repeats=1):
+    """Seconds taken by each loader's access pattern on inputFile, and MB of X they return"""
+    rng = np.random.default_rng(0)
+    with h5py.File(inputFile,'r') as hf:
+        X = hf["X"]
+        n_objects = X.shape[0]
+        row_mb = min(n_channels, X.shape[1])*min(lc_length, X.shape[2])*X.dtype.itemsize/2**20
+        chunk_starts = np.arange(0, n_objects, chunk_size)
+        rows = rng.choice(n_objects, min(n_ids, n_objects), replace=False)
+
+        def read_all():
+            X[:, 0:n_channels, 0:lc_length]
+        def read_chunks():
+            for start in chunk_starts:
+                X[start:start+chunk_size, 0:n_channels, 0:lc_length]
+        def read_ids():
+            read_rows(X, rows, (slice(0,n_channels), slice(0,lc_length)))
+
+        return {
+            "LCs": (timed(read_all, repeats), n_objects*row_mb),
+            "CachedLCs": (timed(read_chunks, repeats), n_objects*row_mb),
+            "get_by_ids": (timed(read_ids, repeats), len(rows)*row_mb)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="rewrites a vectors .h5 file with other chunk shapes and codecs "
+        "and reports read throughput of each layout")
+    parser.add_argument("input_file", help=".h5 file written by save_vectors")
+    parser.add_argument("--output_dir", default=".", help="where rewritten files are written")
+    parser.add_argument("--codecs", nargs="+", default=["gzip", "lzf", "none"],
+        help="codecs to try: none, lzf, gzip, gzip1 to gzip9, blosc or blosc-<compressor> (needs hdf5plugin), "
+        "or contiguous (uncompressed and unchunked, to be memory mapped by MemmapLCs)")
+    parser.add_argument("--rows_per_chunk", type=int, nargs="+", default=[None],
+        help="rows per chunk to try, about 64KB chunks by default")
+    parser.add_argument("--n_channels", type=int, default=None, help="channels the loaders read, all by default")
+    parser.add_argument("--lc_length", type=int, default=None, help="points per light curve the loaders read, all by default")
+    parser.add_argument("--split_chunks", action="store_true",
+        help="split chunks at n_channels and lc_length, so the rest is never decompressed")
+    parser.add_argument("--dtype", default=None, help="type X is stored as, e.g. float16 to halve its size, the same by default")
+    parser.add_argument("--chunk_size", type=int, default=100000, help="chunk size of CachedLCs")
+    parser.add_argument("--n_ids", type=int, default=2000, help="number of random objects looked up by id")
+    parser.add_argument("--repeats", type=int, default=1, help="reads per measure, the fastest one is reported")
+    parser.add_argument("--keep", action="store_true", help="keep rewritten files, only the fastest one is kept otherwise")
+    args = parser.parse_args()
+
+    with h5py.File(args.input_file,'r') as hf:
+        shape = hf["X"].shape
+        print("X", shape, hf["X"].dtype, "chunks", hf["X"].chunks, "compression", hf["X"].compression)
+    n_channels = args.n_channels or shape[1]
+    lc_length = args.lc_length or shape[2]
+    patterns = ["LCs", "CachedLCs", "get_by_ids"]
+
+    layouts = [("original", args.input_file, None)]
+    name = os.path.splitext(os.path.basename(args.input_file))[0]
+    for codec in args.codecs:
+        for rows_per_chunk in ([None] if codec == "contiguous" else args.rows_per_chunk):
+            outputFile = os.path.join(args.output_dir, "{}_{}_{}.h5".format(name, codec, rows_per_chunk or "auto"))
+            print("writing", outputFile)
+            chunks = relayout_vectors(args.input_file, outputFile, codec, rows_per_chunk,
+                n_channels if args.split_chunks else None, lc_length if args.split_chunks else None, dtype=args.dtype)
+            layouts.append((codec, outputFile, chunks))
+
+    print("{:<10} {:<18} {:>9} ".format("codec", "chunks", "size MB")+" ".join("{:>14}".format(p+" MB/s") for p in patterns))
+    results = []
+    for codec, outputFile, chunks in layouts:
+        throughput = read_throughput(outputFile, n_channels, lc_length, args.chunk_size, args.n_ids, args.repeats)
+        if chunks is None:
+            with h5py.File(outputFile,'r') as hf:
+                chunks = hf["X"].chunks
+        size = os.path.getsize(outputFile)/2**20
+        print("{:<10} {:<18} {:>9.1f} ".format(codec, str(chunks), size)+
+            " ".join("{:>14.1f}".format(throughput[p][1]/throughput[p][0]) for p in patterns))
+        results.append((outputFile, throughput))
+
+    #fastest for the pattern used to train (CachedLCs)
+    rewritten = results[1:]
+    if rewritten and not args.keep:
+        best = min(rewritten, key=lambda result: result[1]["CachedLCs"][0])[0]
+        for outputFile, throughput in rewritten:
+            if outputFile != best:
+                os.remove(outputFile)
+        print("kept", best)
@@ -0,0 +1,186 @@
+import hashlib
+import inspect
+import json
+import os
+import h5py
+import numpy as np
+from preprocess_data_utils import save_vectors, write_vectors_in_order
+from shard_utils import read_manifest, check_shards, write_vectors_in_shards
+
+"""Content addressed cache for generated .hdf5 files. A key is the hash of the raw
+input files, the parameters and the code used to vectorize them, and it is stored
+as an attribute of the .hdf5 files generated with it, so a file can be reused as
+long as none of them change."""
+
+def load_digests(cache_dir=".preprocessing_cache"):
+    """Reads the digests remembered in cache_dir/digests.json, see file_digest"""
+    digests_file = os.path.join(cache_dir, "digests.json")
+    if not os.path.exists(digests_file):
+        return {}
+    with open(digests_file) as f:
+        return json.load(f)
+
+def save_digests(digests, cache_dir=".preprocessing_cache"):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, "digests.json"), "w") as f:
+        json.dump(digests, f)
+
+def file_digest(filename, cache_dir=".preprocessing_cache", digests=None):
+    """Returns the sha256 of the contents of filename. Digests are remembered in
+    cache_dir/digests.json and only recomputed if the size or mtime of the file change
+    Parameters
+    ----------
+    filename: str, path to file
+    cache_dir: str, optional. Directory where digests are remembered
+    digests: dict, optional. Digests read with load_digests, updated in place instead of
+        reading and writing digests.json on every call (save them with save_digests)
+    Returns
+    -------
+    digest: str
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    remembered = digests if digests is not None else load_digests(cache_dir)
+    if path in remembered and remembered[path][0:2] == [stat.st_size, stat.st_mtime_ns]:
+        return remembered[path][2]
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    remembered[path] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+    if digests is None:
+        save_digests(remembered, cache_dir)
+    return sha.hexdigest()
+
+def cache_key(input_files=(), params=None, code=(), cache_dir=".preprocessing_cache", digests=None):
+    """Hashes the contents of input_files, params and the source files where the
+    functions (or modules) in code are defined into a single key
+    Parameters
+    ----------
+    input_files: list of str, paths to raw input files
+    params: dict, optional. Parameters of the vectorization, must be json serializable
+    code: list of functions or modules whose source files version the output
+    cache_dir: str, optional. Directory where file digests are remembered
+    digests: dict, optional. See file_digest
+    Returns
+    -------
+    key: str
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+    for filename in input_files:
+        sha.update(file_digest(filename, cache_dir, digests).encode())
+    for source_file in sorted(set(inspect.getsourcefile(c) for c in code)):
+        with open(source_file, "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+def prune_parts(outputFile, keys, cache_dir=".preprocessing_cache"):
+    """Removes the cached parts outputFile was built from last time that it (or any other
+    output sharing cache_dir) doesn't use anymore. Parts used by each output are
+    remembered in cache_dir/parts.json"""
+    parts_file = os.path.join(cache_dir, "parts.json")
+    used = {}
+    if os.path.exists(parts_file):
+        with open(parts_file) as f:
+            used = json.load(f)
+    output = os.path.abspath(outputFile)
+    previous = set(used.get(output, []))
+    used[output] = list(keys)
+    in_use = set(k for output_keys in used.values() for k in output_keys)
+    for key in previous-in_use:
+        part = os.path.join(cache_dir, key+".h5")
+        if os.path.exists(part):
+            os.remove(part)
+    with open(parts_file, "w") as f:
+        json.dump(used, f)
+
+def is_up_to_date(outputFile, key, verify=False):
+    """Whether outputFile exists and was generated with key. outputFile can also be the
+    manifest of a sharded dataset, whose shards must all be unchanged: same size and mtime,
+    or same sha256 with verify (which reads the whole dataset, see check_shards)"""
+    if not os.path.exists(outputFile):
+        return False
+    if outputFile.endswith(".json"):
+        return read_manifest(outputFile).get("cache_key") == key and not check_shards(outputFile, verify)
+    try:
+        with h5py.File(outputFile, 'r') as hf:
+            return hf.attrs.get("cache_key") == key
+    except OSError:
+        return False
+
+def mark_up_to_date(outputFile, key):
+    """Stores key in outputFile, to be checked by is_up_to_date"""
+    with h5py.File(outputFile, 'a') as hf:
+        hf.attrs["cache_key"] = key
+
+def save_cached_vectors(dataset, outputFile, key):
+    """Like save_vectors, but also keeps scalar entries of dataset as attributes and stamps key"""
+    save_vectors(dataset, outputFile)
+    with h5py.File(outputFile, 'a') as hf:
+        for name, value in dataset.items():
+            if np.isscalar(value):
+                hf.attrs[name] = value
+        hf.attrs["cache_key"] = key
+
+def load_cached_vectors(inputFile):
+    """Reads a file written by save_cached_vectors back into a dataset dictionary"""
+    with h5py.File(inputFile, 'r') as hf:
+        dataset = {name: hf[name][:] for name in hf if isinstance(hf[name], h5py.Dataset)}
+        dataset.update({name: value.item() if hasattr(value, "item") else value
+            for name, value in hf.attrs.items() if name != "cache_key"})
+    return dataset
+
+def cached_vectors(jobs, vectorize, outputFile, inputs, params=None, code=(), transform=None,
+    map_function=map, cache_dir=".preprocessing_cache", shard_size=None):
+    """Writes the vectors of all jobs into outputFile, reusing previous results when possible.
+    Each job's vectors are cached in cache_dir under a key of its input files, params, the
+    job itself and code, so only jobs whose inputs changed are vectorized again. If nothing
+    changed at all, the existing outputFile is kept as it is. Parts no output uses
+    anymore are removed (see prune_parts).
+    Parameters
+    ----------
+    jobs: list, arguments for vectorize, one per job
+    vectorize: function, takes a job and returns a dict in the format {"X":,"ids":,"Y":}
+        (other scalar entries are cached too)
+    outputFile: str, path to .hdf5 ouput
+    inputs: list of lists of str, raw input files each job reads
+    params: dict, optional. Parameters shared by all jobs (length, zero points, ...)
+    code: list of functions or modules whose source files version the output, vectorize
+        is always included
+    transform: function, optional. Applied to the (ordered) stream of datasets before writing
+    map_function: function, optional. Used to run vectorize over the jobs to (re)compute,
+        e.g. pool.imap
+    cache_dir: str, optional. Directory where per job results are kept
+    shard_size: int, optional. If given, outputFile is the manifest.json of a sharded dataset
+        with shards of shard_size objects (see shard_utils.write_vectors_in_shards)
+    Returns
+    -------
+    n_computed: int, number of jobs that had to be vectorized
+    """
+    code = list(code) + [getattr(vectorize, "func", vectorize)] #partials are versioned by their function
+    digests = load_digests(cache_dir)
+    keys = [cache_key(files, dict(params or {}, job=job), code, cache_dir, digests) for job, files in zip(jobs, inputs)]
+    save_digests(digests, cache_dir)
+    key = hashlib.sha256("".join(keys).encode()).hexdigest()
+    if is_up_to_date(outputFile, key):
+        print(outputFile+" is up to date")
+        return 0
+
+    os.makedirs(cache_dir, exist_ok=True)
+    parts = [os.path.join(cache_dir, k+".h5") for k in keys]
+    missing = [i for i, part in enumerate(parts) if not is_up_to_date(part, keys[i])]
+    for i, dataset in zip(missing, map_function(vectorize, [jobs[i] for i in missing])):
+        save_cached_vectors(dataset, parts[i], keys[i])
+
+    datasets = (load_cached_vectors(part) for part in parts)
+    if transform:
+        datasets = transform(datasets)
+    if shard_size:
+        write_vectors_in_shards(datasets, outputFile, shard_size, cache_key=key)
+    else:
+        write_vectors_in_order(datasets, outputFile)
+        mark_up_to_date(outputFile, key)
+    prune_parts(outputFile, keys, cache_dir)
+    return len(missing)
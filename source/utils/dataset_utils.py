@@ -3,7 +3,8 @@ import numpy as np
 from torch.utils.data import Dataset
 import h5py
 from torch.utils.data import Subset
-from datasets import CachedLCs
+from datasets import CachedLCs, ShardedLCs
+from preprocess_data_utils import read_label_index
 
 
 
@@ -63,9 +64,18 @@ def cached_dataset_indices_sequential_split(dataset, dataset_lengths, max_chunks
     return subsets_indices
 
 
+def chunked_subset(dataset, indices, chunksize=100000):
+    """Dataset over the same file (or shards) as a chunked dataset, covering only indices,
+    e.g. a fold of CVExperiment"""
+    if isinstance(dataset, ShardedLCs):
+        return ShardedLCs(dataset.lc_length, dataset.manifest_file, dataset.n_channels, dataset.transform, dataset.shards,
+            indices, dataset.cache_shards, dataset.device, dataset.storage_dtype)
+    return CachedLCs(dataset.lc_length, dataset.dataset_file,chunksize,len(indices),indices,dataset.transform,dataset.prefetch,dataset.device,dataset.storage_dtype)
+
+
 def cached_dataset_random_split(dataset,dataset_lengths,chunksize=100000):
     subsets_indices=cached_dataset_indices_split(dataset,dataset_lengths,max_chunksize=chunksize)
-    return [CachedLCs(dataset.lc_length, dataset.dataset_file,chunksize,len(idx),idx,dataset.transform) for idx in subsets_indices]
+    return [CachedLCs(dataset.lc_length, dataset.dataset_file,chunksize,len(idx),idx,dataset.transform,dataset.prefetch,dataset.device,dataset.storage_dtype) for idx in subsets_indices]
 
 
 def cached_crossvalidator_split(dataset,dataset_lengths,chunksize=100000):
@@ -78,3 +88,23 @@ def cached_crossvalidator_split(dataset,dataset_lengths,chunksize=100000):
         train_index = np.delete(indices,val_index)
         # print(train_index)
         yield train_index, validation_index
+
+
+def stratified_indices_split(dataset, dataset_lengths):
+    """Splits the indices of a dataset (LCs or CachedLCs over a whole file) into random
+    subsets of the given lengths, keeping the class proportions of the file in each of them.
+    Classes are read from the file's label index, so no data is loaded.
+    """
+    if sum(dataset_lengths)>len(dataset):
+        raise ValueError("Sum of input lengths is greater than the length of the dataset")
+
+    dataset_file = dataset.dataset_file if hasattr(dataset, "dataset_file") else dataset.dataset_h5
+    index = read_label_index(dataset_file, ["class_rows", "class_offsets"])
+    class_rows = np.split(index["class_rows"], index["class_offsets"][1:-1])
+    #rows of every class get evenly spread ranks in [0,1), sorting by them interleaves the
+    #classes in proportion, so any run of consecutive rows is (roughly) stratified
+    rows = [np.random.permutation(r) for r in class_rows if len(r)]
+    ranks = [(np.arange(len(r))+np.random.rand())/len(r) for r in rows]
+    order = np.concatenate(rows)[np.argsort(np.concatenate(ranks), kind="stable")]
+    ends = np.cumsum(dataset_lengths)
+    return [np.sort(order[end-length:end]) for length, end in zip(dataset_lengths, ends)]
@@ -2,6 +2,12 @@
 import pandas as pd
 import numpy as np
 import h5py
+import os
+try:
+    #registers blosc and other compression filters with h5py, only needed for files that use them
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 
 # plasticc_sn_tags = {'90':0, '67':1, '52':2, '42':3, '62': 4, '95': 5}
 # plasticc_sn_tags =[90,67,52,42,62,95]
@@ -58,11 +64,135 @@ def retag_plasticc(metadata,plasticc_tags):
     sn_metadata.loc[:,"true_target"] = [plasticc_tags.index(tag) for tag in sn_metadata["true_target"]]
     return sn_metadata
 
+def part_row_ranges(data_file, tags, n_parts, chunk_size=1000000, id_column="object_id"):
+    """Splits the objects of a PLAsTiCC file that are in tags into n_parts contiguous object_id
+    ranges (the parts of stream_plasticc_file) and finds the rows of the file each part spans,
+    reading only the id column once, so every part can then read only its own rows
+    Parameters
+    ----------
+    data_file: str, path to .csv with light curve points in the PLAsTiCC format
+    tags: pandas DataFrame, with an object_id column
+    n_parts: int, number of parts
+    chunk_size: int, optional. Number of rows of the id column read at a time
+    Returns
+    -------
+    parts : list of (first_row, stop_row, first_id, last_id) per part, rows are 0 based data
+        rows (without the header), (0, 0, None, None) for empty parts
+    """
+    run_ids, run_starts, n_rows = [], [], 0
+    for chunk in pd.read_csv(data_file, usecols=[id_column], chunksize=chunk_size):
+        chunk_ids = chunk[id_column].values
+        starts = np.flatnonzero(np.concatenate(([True], chunk_ids[1:] != chunk_ids[:-1])))
+        run_ids.append(chunk_ids[starts])
+        run_starts.append(starts+n_rows)
+        n_rows += len(chunk_ids)
+    run_ids = np.concatenate(run_ids) if run_ids else np.zeros(0, dtype=np.int64)
+    run_starts = np.concatenate(run_starts) if run_starts else np.zeros(0, dtype=np.int64)
+    run_stops = np.append(run_starts[1:], n_rows)
+    ids = np.unique(run_ids[np.isin(run_ids, tags["object_id"])])
+    parts = []
+    for part_ids in np.array_split(ids, n_parts):
+        if part_ids.size == 0:
+            parts.append((0, 0, None, None))
+            continue
+        runs = np.isin(run_ids, part_ids)
+        parts.append((int(run_starts[runs].min()), int(run_stops[runs].max()), int(part_ids[0]), int(part_ids[-1])))
+    return parts
+
+def stream_plasticc_file(data_file, tags, length=128, part=0, n_parts=1, keep_raw=False, chunk_size=None, compact=False,
+    part_rows=None, raw=False):
+    """Reads a PLAsTiCC light curve file, keeps the objects that are in tags and yields
+    them as interpolated vectors. If chunk_size is given the file is streamed in chunks
+    of rows (see read_objects_in_chunks) and one dataset is yielded per chunk, so memory
+    use does not depend on the size of the file.
+    Parameters
+    ----------
+    data_file: str, path to .csv with light curve points in the PLAsTiCC format
+    tags: pandas DataFrame, with object_id and true_target columns, as returned by retag_plasticc
+    length: int, optional. Desired length of interpolated light curves.
+    part: int, optional. Which part of the objects in the file to vectorize
+    n_parts: int, optional. Number of parts (contiguous object_id ranges) the objects
+        in the file are split into, so one file can be spread over several workers
+    keep_raw: bool, optional. If True the raw points are returned too, for sanity checks
+    chunk_size: int, optional. Number of rows read at a time, None reads the whole file
+    compact: bool, optional. If True, distance channels are not built, see create_compact_vectors
+    part_rows: tuple, optional. (first_row, stop_row, first_id, last_id) of the part, as given by
+        part_row_ranges. Only those rows of the file are read, instead of the whole file per part
+    raw: bool, optional. If True, raw light curves (see raw_lcs) are yielded instead of vectors
+    Returns
+    -------
+    generator of dicts in the format {"X":,"ids":,"Y":}, plus "raw" if keep_raw
+    """
+    tags = tags[["object_id","true_target"]]
+    if part_rows is not None:
+        first_row, stop_row, first_id, last_id = part_rows
+        if stop_row <= first_row:
+            return
+        rows = dict(skiprows=range(1, first_row+1), nrows=stop_row-first_row)
+        tags = tags[(tags["object_id"] >= first_id) & (tags["object_id"] <= last_id)]
+        ids = tags["object_id"].values
+        if chunk_size:
+            chunks = read_objects_in_chunks(data_file, chunk_size, "object_id", ids=ids, **rows)
+        else:
+            data = pd.read_csv(data_file, **rows)
+            chunks = [data[data["object_id"].isin(ids)]]
+    elif chunk_size:
+        ids = tags["object_id"].values
+        if n_parts > 1:
+            ids = unique_ids_in_chunks(data_file, chunk_size, "object_id")
+            ids = np.array_split(ids[np.isin(ids, tags["object_id"])], n_parts)[part]
+        chunks = read_objects_in_chunks(data_file, chunk_size, "object_id", ids=ids)
+    else:
+        data = pd.read_csv(data_file)
+        data = data[data["object_id"].isin(tags["object_id"])]
+        ids = np.array_split(np.sort(data["object_id"].unique()), n_parts)[part]
+        chunks = [data[data["object_id"].isin(ids)]]
+
+    for data in chunks:
+        ids = data["object_id"].unique()
+        if ids.size == 0:
+            continue
+        #vectors come out sorted by object_id, tags have to follow the same order
+        chunk_tags = tags[tags["object_id"].isin(ids)].sort_values("object_id")
+        if raw:
+            yield raw_lcs(data, chunk_tags, n_passbands=6)
+            continue
+        if compact:
+            dataset = create_compact_vectors(data, chunk_tags, length, n_passbands=6)
+        else:
+            X, obj_ids, Y = create_interpolated_vectors(data, chunk_tags, length, n_passbands=6)
+            dataset = {"X":X, "ids":obj_ids, "Y":Y}
+        if keep_raw:
+            dataset["raw"] = data
+        yield dataset
+
+def vectorize_plasticc_file(data_file, tags, length=128, part=0, n_parts=1, keep_raw=False, chunk_size=None, compact=False,
+    part_rows=None):
+    """Same as stream_plasticc_file, but returns a single dataset with all the vectors.
+    Meant to be run by the workers of a process pool, one call per file or per part of a file.
+    Returns
+    -------
+    dataset: dict in the format {"X":,"ids":,"Y":}, plus "raw" if keep_raw
+    """
+    datasets = list(stream_plasticc_file(data_file, tags, length, part, n_parts, keep_raw, chunk_size, compact, part_rows))
+    if not datasets:
+        datasets = [{"X":np.zeros((0,6 if compact else 12,length),dtype=np.float32), "ids":np.zeros(0,dtype=np.int64),
+            "Y":np.zeros(0,dtype=np.int64), "raw":pd.DataFrame()}]
+        if compact:
+            datasets[0].update(obs_counts=np.zeros((0,6),dtype=np.uint16), obs_time=np.zeros(0))
+    dataset = {key: np.concatenate([d[key] for d in datasets]) for key in ["X","ids","Y","obs_counts","obs_time"]
+        if key in datasets[0]}
+    if keep_raw:
+        dataset["raw"] = pd.concat([d["raw"] for d in datasets])
+    return dataset
+
 """for files in Simsurvey format (.pkl)"""
 
 def pkl_to_df(pkl_filename, first_id = 0):
     """Receives a path to a .pkl produced by simsurvey and returns a pandas DataFrame with the
-    same light curves in an easier to handle format
+    same light curves in an easier to handle format. The fields of all light curves are
+    concatenated straight into typed numpy columns. Points in bands other than ztfr and
+    ztfg (desi) are dropped.
     ----------
     pkl_filename : str, path to .pkl produced by simsurvey that contains simulated light curves
     first_id: int, optional. the first numerical id to be used when assigning it to a simulated light curve.
@@ -71,20 +201,19 @@ def pkl_to_df(pkl_filename, first_id = 0):
         id, time, band, flux, fluxerr for a given point in a light curve
     """
     sn_data = pd.read_pickle(pkl_filename)
-    df = pd.DataFrame(data=sn_data["lcs"], dtype=np.int8)
-    df_sn = df.stack(dropna=True)
-    df_sn = df_sn.to_frame()
-    df_sn.reset_index(level=0, inplace=True)
-    df_sn=df_sn.rename(columns={"level_0": "id", 0: "X"})
-    df_sn["id"]= df_sn["id"]+first_id
-    df_sn["time"] = df_sn["X"].str[0]
-    df_sn["band"] = df_sn["X"].str[1]
-    df_sn["flux"] = df_sn["X"].str[2]
-    df_sn["fluxerr"] = df_sn["X"].str[3]
-    df_sn= df_sn.drop("X",axis=1)
-    df_sn=df_sn[df_sn.band != 'desi']
-    df_sn.loc[df_sn.band == 'ztfr', 'band'] = 0
-    df_sn.loc[df_sn.band == 'ztfg', 'band'] = 1
+    lcs = [np.asarray(lc) for lc in sn_data["lcs"]]
+    #fields are time, band, flux, fluxerr, ... in this order
+    names = lcs[0].dtype.names[0:4]
+    lengths = np.array([len(lc) for lc in lcs])
+    columns = [np.concatenate([lc[name] for lc in lcs]) for name in names]
+    band = columns[1].astype(str)
+    df_sn = pd.DataFrame({
+        "id": np.repeat(np.arange(len(lcs), dtype=np.int64)+first_id, lengths),
+        "time": columns[0].astype(np.float64),
+        "band": np.where(band == 'ztfg', 1, 0),
+        "flux": columns[2].astype(np.float64),
+        "fluxerr": columns[3].astype(np.float64)})
+    df_sn = df_sn[(band == 'ztfr') | (band == 'ztfg')].reset_index(drop=True)
     return df_sn
 
 def is_flux_to_abmag_working(filename, trial_size):
@@ -116,6 +245,55 @@ def is_flux_to_abmag_working(filename, trial_size):
         print("no, it ain't")    
 
 """Miscellaneous"""
+def read_objects_in_chunks(data_file, chunk_size, id_column="id", ids=None, **kwargs):
+    """Reads a .csv file with one light curve point per row in chunks of chunk_size rows
+    and yields DataFrames that only contain complete objects. The rows of the last object
+    of a chunk are carried over to the next one, so no light curve gets split.
+    Rows of the same object have to be contiguous in the file (as in PLAsTiCC files).
+    Parameters
+    ----------
+    data_file: str, path to .csv file
+    chunk_size: int, number of rows read at a time
+    id_column: str, optional. Name of the column with object ids
+    ids: array, optional. If given, only rows of these objects are kept
+    kwargs: passed to pandas.read_csv
+    Returns
+    -------
+    generator of pandas DataFrames with complete objects, in file order
+    """
+    carry = None
+    for chunk in pd.read_csv(data_file, chunksize=chunk_size, **kwargs):
+        if ids is not None:
+            chunk = chunk[chunk[id_column].isin(ids)]
+        if carry is not None and not carry.empty:
+            chunk = pd.concat([carry, chunk])
+        if chunk.empty:
+            continue
+        #rows from the start of the trailing object on might continue in the next chunk
+        chunk_ids = chunk[id_column].values
+        others = np.flatnonzero(chunk_ids != chunk_ids[-1])
+        cut = others[-1]+1 if others.size else 0
+        carry = chunk.iloc[cut:]
+        if cut > 0:
+            yield chunk.iloc[:cut]
+    if carry is not None and not carry.empty:
+        yield carry
+
+def unique_ids_in_chunks(data_file, chunk_size, id_column="id"):
+    """Reads only the id column of a .csv file, in chunks of chunk_size rows,
+    and returns the sorted unique ids in it
+    Parameters
+    ----------
+    data_file: str, path to .csv file
+    chunk_size: int, number of rows read at a time
+    id_column: str, optional. Name of the column with object ids
+    Returns
+    -------
+    ids: numpy array with the unique ids
+    """
+    ids = [chunk[id_column].unique() for chunk in pd.read_csv(data_file, usecols=[id_column], chunksize=chunk_size)]
+    return np.unique(np.concatenate(ids)) if ids else np.array([])
+
 def df_tags(df_sn, t):
     """Receives a Dataframe with lightcurves of a single type 
     and returns column with types for all unique ids
@@ -192,39 +370,177 @@ def ids_for_lasair(metadata_file):
         id_str= id_str+'"'+i+'", '#fix this
     return id_str
 
-"""Functions to generate .hdf5 files that will be loaded as datasets"""
+"""Batched kernels used to vectorize light curves"""
 
-def create_interpolated_vectors(data, tags, length=128, n_passbands=2):
-    """Takes data in the PLAsTiCC format and the corresponding tags and returns the data
-    in the form of linearly interpolated vectors of size length, with extra channels that meassure
-    distances between interpolations and nearest real points. Dismisses fluxerrors.
-    This algorithm was originally coded by mammas for the PLAsTiCC challenge
+def sort_observations(time, flux=None):
+    """Sorts the points of every light curve by time, leaving the nan padding
+    (missing points) at the end of each row
     Parameters
     ----------
-    data: pandas DataFrame, contains data where each row is a lightcurve point.
-        PLAsTiCC columns are is object_id,mjd,flux, passband,
-        Simsurvey format is id, time, flux, band
-        #need to fix this
-    tags: pandas DataFrame, single column with tags of objects ordered by id. 
-        PLAsTiCC column is true_target
-        Simsurvey column is type
-        #need to fix this
-    length: int, optional. Desired length of interpolated light curves.
-    n_passbands: int, optional. Number of passbands in an object
-        PLAsTicc objects have 6 passbands
-        Simsurvey objects have 2 passbands
+    time: 2D numpy array, one light curve per row, nan where there is no point
+    flux: 2D numpy array, optional. Same shape as time, sorted along with it
     Returns
     -------
-    (X, ids, Y) : array with interpolated vectors, ids and tags for them
+    (time, flux, n_points) : sorted time and flux arrays and number of real points per row
+    """
+    valid = ~np.isnan(time)
+    #unstacked light curves usually come sorted already
+    if (valid[:, 1:] <= valid[:, :-1]).all() and not (time[:, 1:] < time[:, :-1]).any():
+        return time, flux, valid.sum(axis=1)
+    order = np.argsort(np.where(valid, time, np.inf), axis=1, kind="stable")
+    time = np.take_along_axis(time, order, axis=1)
+    if flux is not None:
+        flux = np.take_along_axis(flux, order, axis=1)
+    return time, flux, valid.sum(axis=1)
+
+def grid_positions(x, time, n_points, row_offset=0):
+    """For every light curve and every point of the grid x, counts how many real
+    points have a time <= than the grid point. It is the row-wise equivalent of
+    np.searchsorted(time[i], x, side="right"), computed with a single searchsorted
+    over the (shared and sorted) grid instead of one per light curve.
+    Parameters
+    ----------
+    x: numpy array, sorted grid where light curves are evaluated. Either 1D, shared
+        by all light curves, or 2D with one grid per row (nan padded)
+    time: 2D numpy array, sorted times as given by sort_observations
+    n_points: 1D numpy array, number of real points per row
+    row_offset: int, optional. Added to the counts of row i as i*row_offset, so
+        the result can be used directly as a flat index into a 2D array
+    Returns
+    -------
+    counts : 2D int numpy array of shape (n_lcs, x.shape[-1])
+    """
+    n_lcs, max_points = time.shape
+    valid = np.arange(max_points) < n_points[:, np.newaxis]
+    if x.ndim == 2:
+        #sort the points and grid values of each row together (points first when equal)
+        #and count the points of the row that come before every grid value
+        grid = ~np.isnan(x)
+        row = np.concatenate((np.nonzero(valid)[0], np.nonzero(grid)[0]))
+        is_grid = np.repeat([False, True], [valid.sum(), grid.sum()])
+        order = np.lexsort((is_grid, np.concatenate((time[valid], x[grid])), row))
+        points_before = np.cumsum(~is_grid[order])-(np.cumsum(n_points)-n_points)[row[order]]
+        sorted_grid = is_grid[order]
+        counts = np.zeros(grid.sum(), dtype=np.int64)
+        counts[order[sorted_grid]-valid.sum()] = points_before[sorted_grid]
+        positions = np.zeros(x.shape, dtype=np.int64)
+        positions[grid] = counts
+        return positions+np.arange(n_lcs)[:, np.newaxis]*row_offset
+    #grid index from which each real point counts as being <= x
+    if x[0] == 0 and (np.diff(x) == 1).all():
+        first_x = np.clip(np.ceil(time[valid]), 0, x.size).astype(np.int64)
+    else:
+        first_x = np.searchsorted(x, time[valid], side="left")
+    rows = np.nonzero(valid)[0]
+    counts = np.bincount(rows*(x.size+1)+first_x, minlength=n_lcs*(x.size+1))
+    counts = counts.reshape((n_lcs, x.size+1))[:, :x.size]
+    counts[:, 0] += np.arange(n_lcs)*row_offset
+    return np.cumsum(counts, axis=1)
+
+def batch_interp(x, time, flux, chunk_size=5000):
+    """Linearly interpolates every light curve in time/flux at the grid x at once.
+    It gives the same values as calling np.interp(x, time[i], flux[i]) row by row
+    on the real points (sorted by time), and zeros for light curves without any point.
+    Parameters
+    ----------
+    x: numpy array, sorted grid where light curves are evaluated. Either 1D, shared
+        by all light curves, or 2D with one grid per row (nan padded, nan results there)
+    time: 2D numpy array, one light curve per row, nan where there is no point
+    flux: 2D numpy array, same shape as time
+    chunk_size: int, optional. Number of light curves interpolated per batch,
+        bounds the memory used by the temporary arrays
+    Returns
+    -------
+    X : 2D numpy array of shape (n_lcs, x.shape[-1])
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n_lcs, max_points = time.shape
+    X = np.zeros((n_lcs, x.shape[-1]))
+    for start in range(0, n_lcs, chunk_size):
+        stop = min(start+chunk_size, n_lcs)
+        x_chunk = x[start:stop] if x.ndim == 2 else x
+        t, f, n_points = sort_observations(time[start:stop], flux[start:stop])
+        rows = np.arange(stop-start)
+        #1st column is a copy of the 1st point, used left of it (same as np.interp)
+        #slopes are set to 0 there and from the last point on, so the flux is held constant
+        t = np.concatenate((t[:, :1], t), axis=1)
+        f = np.concatenate((f[:, :1], f), axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = np.zeros_like(f)
+            slope[:, 1:-1] = (f[:, 2:]-f[:, 1:-1])/(t[:, 2:]-t[:, 1:-1])
+        slope[rows, n_points] = 0
+        #flat index of the segment each grid point falls in
+        j = grid_positions(x_chunk, t[:, 1:], n_points, row_offset=max_points+1)
+        X_chunk = X[start:stop]
+        np.take(t, j, out=X_chunk)
+        with np.errstate(invalid="ignore"):
+            np.subtract(x_chunk, X_chunk, out=X_chunk)
+            X_chunk *= np.take(slope, j)
+            X_chunk += np.take(f, j)
+        X_chunk[n_points == 0] = 0
+        #non finite fluxes or slopes are rare, let np.interp handle their edge cases
+        real = np.arange(max_points+1) <= n_points[:, np.newaxis]
+        not_finite = (~np.isfinite(f) | ~np.isfinite(slope)) & real
+        for i in np.nonzero(not_finite.any(axis=1) & (n_points > 0))[0]:
+            X_chunk[i] = np.interp(x_chunk[i] if x.ndim == 2 else x, t[i, 1:n_points[i]+1], f[i, 1:n_points[i]+1])
+    return X
+
+def batch_nearest_distance(x, time, fill=500, chunk_size=5000):
+    """Computes, for every light curve in time and every point of the grid x, the
+    distance to the nearest real point. It gives the same values as
+    np.abs(time - x[k]).min(axis=1) ignoring nans, but only looks at the two
+    real points around each grid point (found by binary search on sorted times)
+    instead of scanning all of them, so the cost does not grow with the number of points.
+    Parameters
+    ----------
+    x: numpy array, sorted grid where distances are measured. Either 1D, shared
+        by all light curves, or 2D with one grid per row (nan padded, nan results there)
+    time: 2D numpy array, one light curve per row, nan where there is no point
+    fill: float, optional. Distance given to light curves without any point
+    chunk_size: int, optional. Number of light curves processed per batch
+    Returns
+    -------
+    X_void : 2D numpy array of shape (n_lcs, x.shape[-1])
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n_lcs, max_points = time.shape
+    X_void = np.zeros((n_lcs, x.shape[-1]))
+    for start in range(0, n_lcs, chunk_size):
+        stop = min(start+chunk_size, n_lcs)
+        x_chunk = x[start:stop] if x.ndim == 2 else x
+        t, _, n_points = sort_observations(time[start:stop])
+        rows = np.arange(stop-start)
+        #real points surrounded by -inf and inf, so there are always two neighbours
+        t = np.concatenate((np.full((rows.size, 1), -np.inf), t, np.full((rows.size, 1), np.inf)), axis=1)
+        t[rows, n_points+1] = np.inf
+        #flat index of the last point <= x, the next one is the first point > x
+        j = grid_positions(x_chunk, t[:, 1:-1], n_points, row_offset=max_points+2)
+        X_chunk = X_void[start:stop]
+        np.subtract(x_chunk, np.take(t, j), out=X_chunk)
+        np.minimum(X_chunk, np.take(t, j+1)-x_chunk, out=X_chunk)
+        X_chunk[n_points == 0] = fill
+    return X_void
+
+"""Functions to generate .hdf5 files that will be loaded as datasets"""
+
+def unstack_lcs(data, tags, length=128):
+    """Takes data and tags in the same formats as create_interpolated_vectors and returns
+    the times (scaled to [0, length-1] between the first and last observation of each
+    object) and fluxes of every light curve, one row per object and band (nan padded)
+    Returns
+    -------
+    (time_uns, flux_uns, ids, Y) : 2D arrays of times and fluxes, ids and tags of the objects
     """
-    obj_ids = tags.id.unique()
     data_cp = data.copy()
-    if data.band:#then format is simsurvey like
+    if "band" in data.columns and pd.api.types.is_numeric_dtype(data.id):#then format is simsurvey like
+        data_cp['ob_p']=data.id*10+data.band.astype(int)
+    elif "band" in data.columns:#then format is simsurvey like, with string ids (RAPID)
         data_cp['ob_p']=data.id+data.band.apply(lambda band: str(band))
-    elif data.passband:#then format is plasticc like and we need to change it
+    elif "passband" in data.columns:#then format is plasticc like and we need to change it
         data_cp['ob_p']=data.object_id*10+data.passband
         data_cp=data_cp.rename(columns={"object_id": "id", "mjd": "time","passband":"band"})
-        tags = tags.rename(columns={"true_target":"type"})
+        tags = tags.rename(columns={"object_id": "id", "true_target":"type"})
+    obj_ids = tags.id.unique()
     #sanity check
     # print("there are",data_cp.id.unique().size, "objects")
     # print("there are",data_cp.ob_p.unique().size, "lightcurves")
@@ -250,44 +566,104 @@ def create_interpolated_vectors(data, tags, length=128, n_passbands=2):
     unstack = merged[['ob_p', 'scaled_time', 'flux', 'cc']].set_index(['ob_p', 'cc']).unstack()
     # print("still same number of objects when unstacking?",unstack.shape[0]== data_cp.id.unique().size*n_passbands)
     #transform above info into numpy arrays
-    time_uns = unstack['scaled_time'].values[..., np.newaxis]
-    flux_uns = unstack['flux'].values[..., np.newaxis]
-    time_flux = np.concatenate((time_uns, flux_uns), axis =2)
-    #create a mask to get points that are valid (not nan)
-    #do this for time dim only, since fluxes will be nan when times are also
-    nan_masks = ~np.isnan(time_flux)[:, :, 0]
+    time_uns = unstack['scaled_time'].values.astype(np.float64)
+    flux_uns = unstack['flux'].values.astype(np.float64)
+    return time_uns, flux_uns, obj_ids, tags.type.values
+
+def create_interpolated_vectors(data, tags, length=128, n_passbands=2):
+    """Takes data in the PLAsTiCC format and the corresponding tags and returns the data
+    in the form of linearly interpolated vectors of size length, with extra channels that meassure
+    distances between interpolations and nearest real points. Dismisses fluxerrors.
+    This algorithm was originally coded by mammas for the PLAsTiCC challenge
+    Parameters
+    ----------
+    data: pandas DataFrame, contains data where each row is a lightcurve point.
+        PLAsTiCC columns are is object_id,mjd,flux, passband,
+        Simsurvey format is id, time, flux, band
+        #need to fix this
+    tags: pandas DataFrame, single column with tags of objects ordered by id. 
+        PLAsTiCC column is true_target
+        Simsurvey column is type
+        #need to fix this
+    length: int, optional. Desired length of interpolated light curves.
+    n_passbands: int, optional. Number of passbands in an object
+        PLAsTicc objects have 6 passbands
+        Simsurvey objects have 2 passbands
+    Returns
+    -------
+    (X, ids, Y) : array with interpolated vectors, ids and tags for them
+    """
+    time_uns, flux_uns, obj_ids, Y = unstack_lcs(data, tags, length)
     x = np.arange(length)
-    n_lcs = time_flux.shape[0]
-    #here we'll store interpolated lcs
-    X = np.zeros((n_lcs, x.shape[0]))
-    for i in range(n_lcs):
-        if nan_masks[i].any(): #if any point is real
-            X[i] = np.interp(x, time_flux[i][:, 0][nan_masks[i]], time_flux[i][:, 1][nan_masks[i]])
-        else:
-            X[i] = np.zeros_like(x)
+    n_lcs = time_uns.shape[0]
+    #interpolate all lcs at once, lcs with no real points are left as zeros
+    X = batch_interp(x, time_uns, flux_uns)
 
     n_objs = int(n_lcs/n_passbands)
     #reshape vectors so the ones belonging to the same object are grouped into 2 channels
     X_per_band = X.reshape((n_objs,n_passbands,length)).astype(np.float32)
     #get distance for each point to nearest real point
-    X_void = np.zeros((n_lcs, x.shape[0]))
-    for i in range(length):
-        X_void[:, i] = np.abs((unstack["scaled_time"] - i)).min(axis = 1).fillna(500)
+    X_void = batch_nearest_distance(x, time_uns, fill=500)
     #reshape vectors so the ones belonging to the same object are grouped into n_passbands channels
     X_void_per_band = X_void.reshape((n_objs,n_passbands,length)).astype(np.float32)
     vectors = np.concatenate((X_per_band,X_void_per_band),axis=1)
-    return vectors, obj_ids, tags.type.values
+    return vectors, obj_ids, Y
+
+def create_compact_vectors(data, tags, length=128, n_passbands=2):
+    """Same as create_interpolated_vectors, but without the distance channels. They are a
+    function of the observation times, so the (scaled) times of every light curve are
+    kept instead, and distances are computed again when the vectors are read (see
+    read_vector_rows), with the same values. Files take about half the space and I/O, but
+    chunks are not read faster: computing the distances costs about what decompressing them
+    did (CachedLCs, 5000 objects of 128 points: ~100 ms per chunk, ~90 ms for the full format)
+    Returns
+    -------
+    dataset: dict in the format {"X":,"ids":,"Y":,"obs_counts":,"obs_time":}, X has
+        the n_passbands interpolated channels, see compact_observations for the rest
+    """
+    time_uns, flux_uns, obj_ids, Y = unstack_lcs(data, tags, length)
+    n_objs = int(time_uns.shape[0]/n_passbands)
+    X = batch_interp(np.arange(length), time_uns, flux_uns).reshape((n_objs,n_passbands,length)).astype(np.float32)
+    obs_counts, obs_time = compact_observations(time_uns, n_passbands)
+    return {"X": X, "ids": obj_ids, "Y": Y, "obs_counts": obs_counts, "obs_time": obs_time}
+
+def compact_observations(time_uns, n_passbands=2):
+    """Packs the (nan padded) times of light curves, one row per object and band
+    Returns
+    -------
+    (obs_counts, obs_time) : number of points of each object and band, shape (n_objs, n_passbands),
+        and the sorted times of all light curves one after the other
+    """
+    time, _, n_points = sort_observations(time_uns)
+    obs_time = time[np.arange(time.shape[1]) < n_points[:, np.newaxis]]
+    return n_points.reshape((-1, n_passbands)).astype(np.uint16), obs_time
+
+def observation_distances(obs_counts, obs_time, length=128, fill=500):
+    """Distances from every grid point to the nearest observation of each light curve,
+    the same channels create_interpolated_vectors builds (see compact_observations)
+    Returns
+    -------
+    X_void : float32 array of shape (n_objs, n_passbands, length)
+    """
+    counts = np.asarray(obs_counts).reshape(-1).astype(np.int64)
+    time = np.full((counts.size, max(counts.max(initial=0), 1)), np.nan)
+    time[np.arange(time.shape[1]) < counts[:, np.newaxis]] = obs_time
+    X_void = batch_nearest_distance(np.arange(length), time, fill=fill)
+    return X_void.reshape(np.shape(obs_counts)+(length,)).astype(np.float32)
 
 """Functions to save and update .hdf5 generated files"""
-def append_vectors(dataset,outputFile):
+def append_vectors(dataset,outputFile,index=True):
     """It appends generated dataset dictionary into an existing .hdf5 file
     Parameters
     ----------
     dataset: dict, dataset in the format {"X":,"ids":,"Y":}
     outputFile: str, path to .hdf5 file to update
+    index: bool, optional. Merge the appended rows into the file's label index. Writers
+        appending many blocks pass False and write the index once at the end
     """
     with h5py.File(outputFile, 'a') as hf:
-        X=dataset["X"]
+        first_row = hf["ids"].shape[0]
+        X=cast_vectors(dataset["X"], hf["X"].dtype)
         hf["X"].resize((hf["X"].shape[0] + X.shape[0]), axis = 0)
         hf["X"][-X.shape[0]:] = X
 
@@ -298,23 +674,609 @@ def append_vectors(dataset,outputFile):
         Y=dataset["Y"]
         hf["Y"].resize((hf["Y"].shape[0] + Y.shape[0]), axis = 0)
         hf["Y"][-Y.shape[0]:] = Y
+
+        for key in ["obs_counts","obs_time"]:#compact files, see create_compact_vectors
+            if key in hf and dataset[key].shape[0] > 0:
+                hf[key].resize((hf[key].shape[0] + dataset[key].shape[0]), axis = 0)
+                hf[key][-dataset[key].shape[0]:] = dataset[key]
+
+        if index and "label_index" in hf:
+            group = hf["label_index"]
+            previous = {key: group[key][:] for key in group.keys()}
+            store_label_index(hf, merge_label_index(previous, ids, Y, first_row))
+        elif index:
+            write_label_index(hf, hf["ids"][:], hf["Y"][:])
         hf.close()
 
-def save_vectors(dataset, outputFile):
+def compression_options(codec="gzip"):
+    """Keyword arguments for h5py's create_dataset that compress with codec
+    Parameters
+    ----------
+    codec: str or None, one of "none" (or None), "lzf", "gzip" (level 4), "gzip1" to "gzip9",
+        "blosc" or "blosc-<compressor>" (e.g. "blosc-zstd", needs hdf5plugin)
+    Returns
+    -------
+    options : dict
+    """
+    if codec is None or codec == "none":
+        return {}
+    if codec == "lzf":
+        return {"compression": "lzf"}
+    if codec.startswith("gzip"):
+        return {"compression": "gzip", "compression_opts": int(codec[4:]) if codec[4:] else 4}
+    if codec.startswith("blosc"):
+        if hdf5plugin is None:
+            raise ValueError("codec "+codec+" needs the hdf5plugin package")
+        cname = codec[6:] if codec[6:] else "lz4"
+        return dict(hdf5plugin.Blosc(cname=cname, clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError("unknown codec "+str(codec))
+
+def vector_chunks(shape, itemsize=4, rows_per_chunk=None, n_channels=None, lc_length=None, chunk_bytes=2**16,
+    resizable=True):
+    """Chunk shape for an X dataset of the given shape: chunks hold whole rows (light curves),
+    so reading some rows or a contiguous range of them doesn't decompress the whole file.
+    With n_channels or lc_length, chunks are split there too, so reads of
+    [:, 0:n_channels, 0:lc_length] (as LCs and CachedLCs do) don't decompress the rest
+    Parameters
+    ----------
+    shape: tuple, shape of X (n_objects, channels, length)
+    itemsize: int, optional. Bytes per value
+    rows_per_chunk: int, optional. Rows per chunk, enough for about chunk_bytes by default
+    n_channels, lc_length: int, optional. Channels and points per chunk, all by default
+    chunk_bytes: int, optional. Target size of a chunk, used when rows_per_chunk is not given
+    resizable: bool, optional. Whether X can grow (maxshape=None), then chunks keep their rows
+        even if the first write has less, so a small first block doesn't make every later
+        append use tiny chunks. Otherwise rows per chunk are capped at shape[0]
+    Returns
+    -------
+    chunks : tuple
+    """
+    n_channels = min(n_channels or shape[1], shape[1])
+    lc_length = min(lc_length or shape[2], shape[2])
+    if rows_per_chunk is None:
+        rows_per_chunk = max(chunk_bytes//max(n_channels*lc_length*itemsize, 1), 1)
+    if not resizable:
+        rows_per_chunk = min(rows_per_chunk, shape[0])
+    return (max(rows_per_chunk, 1), n_channels, lc_length)
+
+def cast_vectors(X, dtype=None):
+    """Casts vectors to dtype (e.g. float16 to halve their size), making sure no value
+    is too large for it. Magnitudes and distances (at most 500) fit in float16
+    Parameters
+    ----------
+    X: numpy array
+    dtype: numpy dtype or str, optional. X is returned as it is if not given
+    Returns
+    -------
+    X : numpy array of dtype
+    """
+    if dtype is None or np.dtype(dtype) == X.dtype:
+        return X
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f" and dtype.itemsize < X.dtype.itemsize:
+        with np.errstate(invalid="ignore"):
+            too_large = (np.abs(X) > np.finfo(dtype).max) & np.isfinite(X)
+        if too_large.any():
+            raise ValueError("vectors have values too large for "+str(dtype)+", e.g. "+str(X[too_large][0:5]))
+    return X.astype(dtype)
+
+def save_vectors(dataset, outputFile, codec="gzip", rows_per_chunk=None, dtype=None):
     """It wrotes generated dataset dictionary into a new .hdf5 file
     Parameters
     ----------
     dataset: dict, dataset in the format {"X":,"ids":,"Y":}
     outputFile: str, path to .hdf5 ouput
+    codec: str, optional. Compression of X, see compression_options
+    rows_per_chunk: int, optional. Rows per chunk of X, see vector_chunks
+    dtype: numpy dtype or str, optional. Type X is stored as, e.g. float16 (see cast_vectors)
     """
     hf=h5py.File(outputFile,'w')
 
     print("writing X")
-    hf.create_dataset('X',data=dataset['X'],compression="gzip", chunks=True, maxshape=(None,None,None,))
+    X = cast_vectors(dataset['X'], dtype)
+    #chunks hold whole light curves (~64KB of rows), so reading some rows doesn't decompress the whole file
+    chunks = vector_chunks(X.shape, X.dtype.itemsize, rows_per_chunk)
+    hf.create_dataset('X',data=X, chunks=chunks, maxshape=(None,None,None,), **compression_options(codec))
 
     print("writing ids")
     hf.create_dataset('ids',data=dataset['ids'],dtype='int64',compression="gzip", chunks=True, maxshape=(None,))
     
     print("writing Y")
     hf.create_dataset('Y',data=dataset['Y'],compression="gzip", chunks=True, maxshape=(None,))
-    hf.close()
\ No newline at end of file
+
+    if "obs_time" in dataset:
+        print("writing observations")
+        hf.create_dataset('obs_counts',data=dataset['obs_counts'],compression="gzip", chunks=True, maxshape=(None,None))
+        hf.create_dataset('obs_time',data=dataset['obs_time'],compression="gzip", shuffle=True, chunks=True, maxshape=(None,))
+
+    print("writing label index")
+    write_label_index(hf, np.asarray(dataset['ids']), np.asarray(dataset['Y']))
+    hf.close()
+
+def relayout_vectors(inputFile, outputFile, codec="gzip", rows_per_chunk=None, n_channels=None, lc_length=None,
+    block_rows=100000, dtype=None):
+    """Rewrites a .hdf5 file written by save_vectors with another chunk shape and compression
+    for X (see vector_chunks and compression_options). ids, Y, the label index and attributes
+    are copied as they are. X is copied in blocks of rows, so the file doesn't need to fit in memory.
+    Parameters
+    ----------
+    inputFile: str, path to .hdf5 file
+    outputFile: str, path to new .hdf5 file
+    codec, rows_per_chunk, n_channels, lc_length: str and ints, optional. Layout of X in outputFile.
+        codec="contiguous" stores X uncompressed and unchunked instead, so it can be memory mapped
+        (see memmap_vectors), but not appended to
+    block_rows: int, optional. Rows copied at once, rounded to whole chunks
+    dtype: numpy dtype or str, optional. Type X is stored as, the same as in inputFile by default
+    Returns
+    -------
+    chunks : tuple, chunk shape of X in outputFile (None if contiguous)
+    """
+    with h5py.File(inputFile,'r') as hf_in, h5py.File(outputFile,'w') as hf_out:
+        X = hf_in["X"]
+        dtype = np.dtype(dtype or X.dtype)
+        if codec == "contiguous":
+            chunks = None
+            X_out = hf_out.create_dataset('X', shape=X.shape, dtype=dtype)
+        else:
+            chunks = vector_chunks(X.shape, dtype.itemsize, rows_per_chunk, n_channels, lc_length)
+            X_out = hf_out.create_dataset('X', shape=X.shape, dtype=dtype, chunks=chunks, maxshape=(None,None,None,),
+                **compression_options(codec))
+            block_rows = max(block_rows//chunks[0], 1)*chunks[0]
+        for start in range(0, X.shape[0], block_rows):
+            X_out[start:start+block_rows] = cast_vectors(X[start:start+block_rows], dtype)
+        for name in hf_in:
+            if name == "obs_time" and codec == "contiguous":#memory mapped too
+                hf_out.create_dataset(name, data=hf_in[name][:])
+            elif name != "X":
+                hf_in.copy(hf_in[name], hf_out, name)
+        for name, value in hf_in.attrs.items():
+            hf_out.attrs[name] = value
+    return chunks
+
+def memmap_vectors(inputFile, mode="c", name="X"):
+    """Maps X of a file rewritten with relayout_vectors(codec="contiguous") into memory,
+    without reading it. Slices of it are views, the OS reads pages from disk on first access
+    Parameters
+    ----------
+    inputFile: str, path to .hdf5 file with contiguous X
+    mode: str, optional. np.memmap mode, copy on write by default (changes are not saved)
+    name: str, optional. Dataset to map, obs_time can be mapped too
+    Returns
+    -------
+    X : numpy memmap
+    """
+    with h5py.File(inputFile,'r') as hf:
+        X = hf[name]
+        offset = X.id.get_offset()
+        if X.chunks is not None or X.compression is not None or offset is None:
+            raise ValueError(inputFile+" is not contiguous, rewrite it with relayout_vectors(codec=\"contiguous\")")
+        shape, dtype = X.shape, X.dtype
+    return np.memmap(inputFile, dtype=dtype, mode=mode, offset=offset, shape=shape)
+
+def vector_channels(hf):
+    """Number of channels of the vectors in an open .hdf5 file, including the distance
+    channels compact files (see create_compact_vectors) don't store"""
+    return hf["X"].shape[1]*2 if "obs_time" in hf else hf["X"].shape[1]
+
+_observation_offsets = {} #(file, size, mtime) -> offsets, see observation_offsets
+
+def observation_offsets(hf):
+    """Where the observations of each object start in obs_time of a compact file (offsets[i]
+    for object i, offsets[-1] the number of observations), None for other files. Offsets of
+    files opened read only are remembered, until the file changes"""
+    if "obs_time" not in hf:
+        return None
+    key = None
+    if hf.mode == "r":
+        stat = os.stat(hf.filename)
+        key = (os.path.abspath(hf.filename), stat.st_size, stat.st_mtime_ns)
+        if key in _observation_offsets:
+            return _observation_offsets[key]
+    offsets = np.concatenate(([0], np.cumsum(hf["obs_counts"][:].sum(axis=1, dtype=np.int64))))
+    if key is not None:
+        _observation_offsets[key] = offsets
+    return offsets
+
+def observation_points(obs_offsets, rows):
+    #positions in obs_time of the observations of the objects in rows, in that order
+    rows = np.asarray(rows, dtype=np.int64)
+    counts = obs_offsets[rows+1]-obs_offsets[rows]
+    return np.repeat(obs_offsets[rows]-(np.cumsum(counts)-counts), counts)+np.arange(counts.sum())
+
+def read_vector_rows(hf, start, stop, n_channels=None, lc_length=None, obs_offsets=None):
+    """Reads X[start:stop, 0:n_channels, 0:lc_length] of an open .hdf5 file. Distance
+    channels of compact files (see create_compact_vectors) are computed from their observations,
+    reading n_channels <= n_passbands skips them (and their cost) altogether
+    Parameters
+    ----------
+    hf: open h5py File written by save_vectors
+    start, stop: int, range of rows
+    n_channels, lc_length: int, optional. Only read the first lc_length points and n_channels, all by default
+    obs_offsets: numpy array, optional. observation_offsets of the file, pass it when reading several ranges
+    Returns
+    -------
+    X : numpy array
+    """
+    X = hf["X"][start:stop, 0:n_channels, 0:lc_length]
+    n_passbands = hf["X"].shape[1]
+    n_distances = min(n_channels or vector_channels(hf), vector_channels(hf))-n_passbands
+    if "obs_time" not in hf or n_distances <= 0:
+        return X
+    if obs_offsets is None:
+        obs_offsets = observation_offsets(hf)
+    stop = min(stop, hf["X"].shape[0])
+    obs_time = hf["obs_time"][obs_offsets[start]:obs_offsets[stop]]
+    X_void = observation_distances(hf["obs_counts"][start:stop], obs_time, X.shape[2])
+    return np.concatenate((X, X_void[:, 0:n_distances]), axis=1)
+
+def label_index(ids, Y):
+    """Builds the label and id index of a dataset: how many objects there are of each
+    class, which rows hold each class and which row holds each id
+    Parameters
+    ----------
+    ids: numpy array, ids of the objects (one per row)
+    Y: numpy array, integer tags of the objects (one per row)
+    Returns
+    -------
+    index : dict with
+        class_counts, number of objects of each class (tags 0 to max tag)
+        class_rows and class_offsets, rows of class c are class_rows[class_offsets[c]:class_offsets[c+1]]
+        sorted_ids and id_rows, ids in increasing order and the row of each of them
+    """
+    Y = np.asarray(Y).astype(np.int64)
+    ids = np.asarray(ids).astype(np.int64)
+    class_counts = np.bincount(Y, minlength=0) if Y.size else np.zeros(0, dtype=np.int64)
+    id_rows = np.argsort(ids, kind="stable")
+    return {
+        "class_counts": class_counts,
+        "class_offsets": np.concatenate(([0], np.cumsum(class_counts))),
+        "class_rows": np.argsort(Y, kind="stable"),
+        "sorted_ids": ids[id_rows],
+        "id_rows": id_rows
+    }
+
+def merge_label_index(index, ids, Y, first_row):
+    """Label index of a file after appending rows first_row onwards with ids and Y to a file
+    with the given index, without reading its previous ids and tags. The result is the same
+    as label_index over all the rows
+    Returns
+    -------
+    index : dict, see label_index
+    """
+    new = label_index(ids, Y)
+    n_classes = max(len(index["class_counts"]), len(new["class_counts"]))
+    class_counts = np.zeros(n_classes, dtype=np.int64)
+    class_counts[0:len(index["class_counts"])] += index["class_counts"]
+    class_counts[0:len(new["class_counts"])] += new["class_counts"]
+    #previous rows go first, and stable sorts keep them (and rows within each part) in order
+    classes = np.concatenate((np.repeat(np.arange(len(index["class_counts"])), index["class_counts"]),
+        np.repeat(np.arange(len(new["class_counts"])), new["class_counts"])))
+    class_rows = np.concatenate((index["class_rows"], new["class_rows"]+first_row))[np.argsort(classes, kind="stable")]
+    sorted_ids = np.concatenate((index["sorted_ids"], new["sorted_ids"]))
+    order = np.argsort(sorted_ids, kind="stable")
+    return {
+        "class_counts": class_counts,
+        "class_offsets": np.concatenate(([0], np.cumsum(class_counts))),
+        "class_rows": class_rows.astype(np.int64),
+        "sorted_ids": sorted_ids[order],
+        "id_rows": np.concatenate((index["id_rows"], new["id_rows"]+first_row))[order].astype(np.int64)
+    }
+
+def store_label_index(hf, index):
+    """Writes (or rewrites) the label_index group of an open .hdf5 file"""
+    if "label_index" in hf:
+        del hf["label_index"]
+    group = hf.create_group("label_index")
+    for key, values in index.items():
+        group.create_dataset(key, data=values, compression="gzip" if values.size else None)
+
+def write_label_index(hf, ids, Y):
+    """Writes (or rewrites) the label_index group of an open .hdf5 file, see label_index"""
+    store_label_index(hf, label_index(ids, Y))
+
+def read_label_index(inputFile, keys=None):
+    """Reads the label index of a .hdf5 file written by save_vectors (see label_index).
+    Files written before the index existed get it built from their ids and Y.
+    Parameters
+    ----------
+    inputFile: str, path to .hdf5 file
+    keys: list of str, optional. Parts of the index to read, all by default
+    Returns
+    -------
+    index : dict
+    """
+    with h5py.File(inputFile,'r') as hf:
+        if "label_index" in hf:
+            group = hf["label_index"]
+            return {key: group[key][:] for key in (keys or group.keys())}
+        index = label_index(hf["ids"][:], hf["Y"][:])
+    return {key: index[key] for key in (keys or index.keys())}
+
+def rows_of_ids(ids, sorted_ids, id_rows):
+    """Finds the rows holding each of ids with a binary search over the id index of
+    a file (sorted_ids and id_rows, see label_index)
+    Returns
+    -------
+    rows : numpy array, row of each id, in the same order
+    """
+    ids = np.asarray(ids).astype(np.int64)
+    positions = np.minimum(np.searchsorted(sorted_ids, ids), max(len(sorted_ids)-1, 0))
+    found = sorted_ids[positions] == ids if len(sorted_ids) else np.zeros(ids.shape, dtype=bool)
+    if not found.all():
+        raise ValueError("ids not in dataset: "+str(ids[~found][0:10]))
+    return id_rows[positions]
+
+def read_rows(dataset, rows, columns=(), max_gap=16):
+    """Reads the given rows of an h5py dataset. Rows are sorted and the ones that are
+    adjacent (or at most max_gap rows apart) are read together, with a single slice,
+    instead of one read (and chunk decompression) per row.
+    Parameters
+    ----------
+    dataset: h5py Dataset
+    rows: list or array of row indices, may be repeated or unsorted
+    columns: tuple of slices, optional. Selection on the other axes, e.g. (slice(0,4), slice(0,128))
+    max_gap: int, optional. Largest number of unneeded rows read to join two runs of rows
+    Returns
+    -------
+    values : numpy array with the rows in the order given
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if rows.size == 0:
+        return dataset[(slice(0,0),)+tuple(columns)]
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    breaks = np.nonzero(np.diff(unique_rows) > max_gap+1)[0]+1
+    starts = unique_rows[np.concatenate(([0], breaks))]
+    ends = unique_rows[np.concatenate((breaks-1, [-1]))]+1
+    block = np.concatenate([dataset[(slice(start,end),)+tuple(columns)] for start, end in zip(starts, ends)])
+    run = np.searchsorted(starts, unique_rows, side="right")-1
+    run_offsets = np.cumsum(ends-starts)-(ends-starts)
+    return block[(run_offsets[run]+unique_rows-starts[run])[inverse]]
+
+def load_vectors_by_ids(inputFile, ids, id_index=None, lc_length=None, n_channels=None):
+    """Reads the vectors of the given object ids from a .hdf5 file written by save_vectors,
+    reading only their rows
+    Parameters
+    ----------
+    inputFile: str, path to .hdf5 file
+    ids: list or array of object ids
+    id_index: dict, optional. sorted_ids and id_rows of the file, as given by read_label_index
+        (read from the file if not given, pass it when doing several lookups)
+    lc_length, n_channels: int, optional. Only read the first lc_length points and n_channels
+    Returns
+    -------
+    (X, ids, Y) : vectors, ids and tags of the objects, in the order of ids
+    """
+    if id_index is None:
+        id_index = read_label_index(inputFile, ["sorted_ids", "id_rows"])
+    rows = rows_of_ids(ids, id_index["sorted_ids"], id_index["id_rows"])
+    with h5py.File(inputFile,'r') as hf:
+        X = read_rows(hf["X"], rows, (slice(0,n_channels), slice(0,lc_length)))
+        n_distances = min(n_channels or vector_channels(hf), vector_channels(hf))-hf["X"].shape[1]
+        if "obs_time" in hf and n_distances > 0:
+            obs_time = read_rows(hf["obs_time"], observation_points(observation_offsets(hf), rows))
+            X_void = observation_distances(read_rows(hf["obs_counts"], rows), obs_time, X.shape[2])
+            X = np.concatenate((X, X_void[:, 0:n_distances]), axis=1)
+        return X, read_rows(hf["ids"], rows), read_rows(hf["Y"], rows)
+
+def write_vectors_in_order(datasets, outputFile, buffer_size=100000):
+    """It writes an iterable of generated dataset dictionaries into a new .hdf5 file,
+    in the order they come. Meant to be the single writer consuming the ordered results
+    of a process pool (e.g. pool.imap). Datasets are buffered and appended in blocks of
+    at least buffer_size objects so the file is not resized after every result.
+    Parameters
+    ----------
+    datasets: iterable of dicts in the format {"X":,"ids":,"Y":}
+    outputFile: str, path to .hdf5 ouput
+    buffer_size: int, optional. Minimum number of objects written at once
+    Returns
+    -------
+    n_written: int, number of objects written
+    """
+    buffer = []
+    n_buffered = 0
+    n_written = 0
+    for dataset in datasets:
+        buffer.append(dataset)
+        n_buffered += len(dataset["ids"])
+        if n_buffered >= buffer_size:
+            n_written = _flush_vectors(buffer, outputFile, n_written)
+            buffer = []
+            n_buffered = 0
+    if buffer:
+        n_written = _flush_vectors(buffer, outputFile, n_written)
+    #blocks are appended without index, it's built once for the whole file
+    if n_written > 0:
+        with h5py.File(outputFile, 'a') as hf:
+            write_label_index(hf, hf["ids"][:], hf["Y"][:])
+    return n_written
+
+def _flush_vectors(buffer, outputFile, n_written):
+    dataset = {key: np.concatenate([d[key] for d in buffer]) for key in ["X","ids","Y","obs_counts","obs_time"]
+        if key in buffer[0]}
+    if n_written == 0:
+        save_vectors(dataset, outputFile)
+    else:
+        append_vectors(dataset, outputFile, index=False)
+    return n_written + len(dataset["ids"])
+
+"""Functions to save and load raw light curves (ragged .hdf5 files), so vectors
+of any length can be built when the dataset is loaded"""
+
+def raw_lcs(data, tags, n_passbands=2):
+    """Takes data and tags in the same formats as create_interpolated_vectors and returns
+    the raw points of every object as flat arrays, plus the offset where each object starts.
+    Points are sorted by object (in the order of tags), band and time.
+    Parameters
+    ----------
+    data: pandas DataFrame, contains data where each row is a lightcurve point.
+        PLAsTiCC columns are object_id,mjd,flux,passband(,flux_err)
+        Simsurvey format is id,time,flux,band(,fluxerr)
+    tags: pandas DataFrame, tags of objects. PLAsTiCC columns are object_id,true_target,
+        Simsurvey columns are id,type
+    n_passbands: int, optional. Number of passbands in an object
+    Returns
+    -------
+    dataset: dict in the format {"time":,"band":,"flux":,"flux_err":,"offsets":,"ids":,"Y":,"n_passbands":}
+        "flux_err" is only there if data has flux errors
+    """
+    if "passband" in data.columns:
+        data = data.rename(columns={"object_id": "id", "mjd": "time","passband":"band"})
+        tags = tags.rename(columns={"object_id": "id", "true_target":"type"})
+    obj_ids = tags.id.unique()
+    obj = pd.Index(obj_ids).get_indexer(data.id)
+    band = data.band.values.astype(np.int8)
+    time = data.time.values.astype(np.float64)
+    order = np.lexsort((time, band, obj))
+    order = order[obj[order] >= 0]
+    counts = np.bincount(obj[order], minlength=obj_ids.size)
+    dataset = {
+        "time": time[order],
+        "band": band[order],
+        "flux": data.flux.values.astype(np.float64)[order],
+        "offsets": np.concatenate(([0], np.cumsum(counts))),
+        "ids": np.asarray(obj_ids).astype(np.int64),
+        "Y": tags.drop_duplicates("id").type.values,
+        "n_passbands": n_passbands
+    }
+    for flux_err in ["flux_err", "fluxerr"]:
+        if flux_err in data.columns:
+            dataset["flux_err"] = data[flux_err].values.astype(np.float64)[order]
+    return dataset
+
+def save_raw_lcs(dataset, outputFile):
+    """It writes a raw light curves dictionary (see raw_lcs) into a new .hdf5 file
+    Parameters
+    ----------
+    dataset: dict, in the format returned by raw_lcs
+    outputFile: str, path to .hdf5 ouput
+    """
+    with h5py.File(outputFile,'w') as hf:
+        for key in ["time","band","flux","flux_err","offsets","ids","Y"]:
+            if key in dataset:
+                hf.create_dataset(key,data=dataset[key],compression="gzip", chunks=True, maxshape=(None,))
+        hf.attrs["n_passbands"] = dataset["n_passbands"]
+
+def append_raw_lcs(dataset, outputFile):
+    """It appends a raw light curves dictionary (see raw_lcs) into an existing .hdf5 file
+    Parameters
+    ----------
+    dataset: dict, in the format returned by raw_lcs
+    outputFile: str, path to .hdf5 file to update
+    """
+    with h5py.File(outputFile, 'a') as hf:
+        n_points = hf["time"].shape[0]
+        for key in ["time","band","flux","flux_err","offsets","ids","Y"]:
+            if key not in hf:
+                continue
+            values = dataset[key]
+            if key == "offsets":#first offset is already there, the rest are shifted
+                values = values[1:] + n_points
+            hf[key].resize((hf[key].shape[0] + values.shape[0]), axis = 0)
+            hf[key][hf[key].shape[0]-values.shape[0]:] = values
+
+def vectorize_raw_lcs(time, band, flux, offsets, length=128, n_passbands=2):
+    """Builds the same vectors as create_interpolated_vectors from raw light curves:
+    linear interpolations of each band at length points between the first and last
+    observation of the object, and the distances to the nearest real point.
+    Parameters
+    ----------
+    time, band, flux: 1D numpy arrays, points sorted by object, band and time
+    offsets: 1D numpy array, offsets[i] is where object i starts, offsets[-1] the number of points
+    length: int, optional. Desired length of interpolated light curves.
+    n_passbands: int, optional. Number of passbands in an object
+    Returns
+    -------
+    X : numpy array of shape (n_objs, 2*n_passbands, length), missing bands are
+        interpolated as zeros, with distance 500
+    """
+    n_objs = offsets.size-1
+    counts = np.diff(offsets)
+    obj = np.repeat(np.arange(n_objs), counts)
+    start = offsets[:-1]-offsets[0]
+    time_min = np.minimum.reduceat(time, start[counts > 0]) if time.size else time
+    time_max = np.maximum.reduceat(time, start[counts > 0]) if time.size else time
+    time_min = np.repeat(time_min, counts[counts > 0])
+    time_max = np.repeat(time_max, counts[counts > 0])
+    scaled_time = (length - 1) * (time - time_min)/(time_max-time_min)
+
+    #one (nan padded) row per light curve, objects keep n_passbands consecutive rows
+    row = obj*n_passbands+band
+    row_counts = np.bincount(row, minlength=n_objs*n_passbands)
+    col = np.arange(row.size) - np.repeat(np.cumsum(row_counts)-row_counts, row_counts)
+    time_uns = np.full((n_objs*n_passbands, max(row_counts.max(initial=0), 1)), np.nan)
+    flux_uns = np.full(time_uns.shape, np.nan)
+    time_uns[row, col] = scaled_time
+    flux_uns[row, col] = flux
+
+    x = np.arange(length)
+    X = batch_interp(x, time_uns, flux_uns).reshape((n_objs,n_passbands,length)).astype(np.float32)
+    X_void = batch_nearest_distance(x, time_uns, fill=500).reshape((n_objs,n_passbands,length)).astype(np.float32)
+    return np.concatenate((X,X_void),axis=1)
+
+def load_raw_vectors(inputFile, length=128, batch_size=100000, start=0, stop=None):
+    """Reads a raw light curves .hdf5 file and vectorizes its objects at the given
+    length, batch_size objects at a time
+    Parameters
+    ----------
+    inputFile: str, path to .hdf5 file written by save_raw_lcs
+    length: int, optional. Desired length of interpolated light curves.
+    batch_size: int, optional. Number of objects vectorized at once
+    start, stop: int, optional. Range of objects to load, all by default
+    Returns
+    -------
+    (X, ids, Y) : array with interpolated vectors, ids and tags for them
+    """
+    with h5py.File(inputFile,'r') as hf:
+        n_passbands = int(hf.attrs["n_passbands"])
+        stop = hf["ids"].shape[0] if stop is None else stop
+        X = np.zeros((stop-start, 2*n_passbands, length), dtype=np.float32)
+        for first in range(start, stop, batch_size):
+            last = min(first+batch_size, stop)
+            offsets = hf["offsets"][first:last+1]
+            points = slice(offsets[0], offsets[-1])
+            X[first-start:last-start] = vectorize_raw_lcs(hf["time"][points], hf["band"][points],
+                hf["flux"][points], offsets, length, n_passbands)
+        return X, hf["ids"][start:stop], hf["Y"][start:stop]
+
+def load_raw_vectors_by_ids(inputFile, ids, id_index=None, length=128):
+    """Vectorizes the objects with the given ids of a raw light curves .hdf5 file,
+    reading only their points (see load_vectors_by_ids)
+    Parameters
+    ----------
+    inputFile: str, path to .hdf5 file written by save_raw_lcs
+    ids: list or array of object ids
+    id_index: dict, optional. sorted_ids and id_rows of the file, as given by read_label_index
+        (built from the file if not given, pass it when doing several lookups)
+    length: int, optional. Desired length of interpolated light curves.
+    Returns
+    -------
+    (X, ids, Y) : vectors, ids and tags of the objects, in the order of ids
+    """
+    if id_index is None:
+        id_index = read_label_index(inputFile, ["sorted_ids", "id_rows"])
+    rows = rows_of_ids(ids, id_index["sorted_ids"], id_index["id_rows"])
+    with h5py.File(inputFile,'r') as hf:
+        n_passbands = int(hf.attrs["n_passbands"])
+        obj_offsets = read_rows(hf["offsets"], np.concatenate((rows, rows+1)))
+        starts, stops = obj_offsets[0:rows.size], obj_offsets[rows.size:]
+        offsets = np.concatenate(([0], np.cumsum(stops-starts)))
+        #points of each object are contiguous, read_rows reads each object with one slice
+        points = np.repeat(starts-offsets[:-1], stops-starts)+np.arange(offsets[-1])
+        X = vectorize_raw_lcs(read_rows(hf["time"], points), read_rows(hf["band"], points),
+            read_rows(hf["flux"], points), offsets, length, n_passbands)
+        return X, read_rows(hf["ids"], rows), read_rows(hf["Y"], rows)
+
+def write_raw_lcs_in_order(datasets, outputFile):
+    """Like write_vectors_in_order, for raw light curves dictionaries (see raw_lcs)
+    Returns
+    -------
+    n_written: int, number of objects written
+    """
+    n_written = 0
+    for dataset in datasets:
+        if n_written == 0:
+            save_raw_lcs(dataset, outputFile)
+        else:
+            append_raw_lcs(dataset, outputFile)
+        n_written += len(dataset["ids"])
+    return n_written
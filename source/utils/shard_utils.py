@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import re
+import h5py
+import numpy as np
+from preprocess_data_utils import save_vectors, observation_offsets
+
+"""Sharded datasets: vectors written as a directory of .hdf5 files of shard_size objects
+each (in the format of save_vectors) plus a manifest.json describing them, so shards can
+be read by different processes or machines in parallel (see datasets.ShardedLCs) and new
+data is added as new shards instead of resizing a single file.
+
+The manifest holds, for every shard, its file (relative to the manifest), the range of
+rows it covers in the whole dataset, its class histogram, its sha256 and the size and
+mtime it was written with."""
+
+def shard_checksum(filename):
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def read_manifest(manifestFile):
+    """Reads the manifest of a sharded dataset
+    Returns
+    -------
+    manifest : dict, with "shards" a list of dicts with "file", "start", "stop", "class_counts", "sha256",
+        "size" and "mtime_ns"
+    """
+    with open(manifestFile) as f:
+        return json.load(f)
+
+def shard_files(manifestFile, manifest=None):
+    #absolute paths of the shards, in order
+    manifest = manifest or read_manifest(manifestFile)
+    directory = os.path.dirname(os.path.abspath(manifestFile))
+    return [os.path.join(directory, shard["file"]) for shard in manifest["shards"]]
+
+def shard_changed(filename, shard, verify=True):
+    #with verify the contents are hashed, otherwise only size and mtime are compared
+    if not os.path.exists(filename):
+        return True
+    if not verify and "size" in shard:
+        stat = os.stat(filename)
+        return [stat.st_size, stat.st_mtime_ns] != [shard["size"], shard["mtime_ns"]]
+    return shard_checksum(filename) != shard["sha256"]
+
+def check_shards(manifestFile, verify=True):
+    """Returns the files of the shards that don't match the manifest (missing or changed)
+    Parameters
+    ----------
+    manifestFile: str, path to manifest.json
+    verify: bool, optional. Compare the sha256 of every shard, which reads the whole dataset.
+        If False, only their size and mtime are compared
+    Returns
+    -------
+    changed: list of str, paths of shards that are missing or changed
+    """
+    manifest = read_manifest(manifestFile)
+    return [filename for filename, shard in zip(shard_files(manifestFile, manifest), manifest["shards"])
+        if shard_changed(filename, shard, verify)]
+
+def shards_of_rank(n_shards, rank, world_size):
+    """Shards read by process rank out of world_size, so processes (or machines) read disjoint shards"""
+    return list(range(rank, n_shards, world_size))
+
+def slice_vectors(dataset, start, stop):
+    #rows start:stop of a dataset dictionary, with the observations of compact datasets
+    part = {key: dataset[key][start:stop] for key in ["X","ids","Y","obs_counts"] if key in dataset}
+    if "obs_time" in dataset:
+        offsets = np.concatenate(([0], np.cumsum(dataset["obs_counts"].sum(axis=1, dtype=np.int64))))
+        part["obs_time"] = dataset["obs_time"][offsets[start]:offsets[min(stop, len(offsets)-1)]]
+    return part
+
+def write_vectors_in_shards(datasets, manifestFile, shard_size=100000, append=False, cache_key=None, **save_options):
+    """It writes an iterable of generated dataset dictionaries as shards of shard_size objects,
+    in the order they come, and the manifest describing them. Same as write_vectors_in_order,
+    but nothing is ever resized, so it can also add shards to an existing sharded dataset.
+    Parameters
+    ----------
+    datasets: iterable of dicts in the format {"X":,"ids":,"Y":} (or of create_compact_vectors)
+    manifestFile: str, path to manifest.json, shards are written in the same directory
+    shard_size: int, optional. Number of objects per shard, the last one may have less
+    append: bool, optional. If True, data is added after the one of an existing manifest
+        (with the same shard_size), topping up its last shard first so shards stay full
+    cache_key: str, optional. Stored in the manifest, see cache_utils.cached_vectors
+    save_options: optional arguments of save_vectors (codec, rows_per_chunk, dtype)
+    Returns
+    -------
+    n_written: int, number of objects written
+    """
+    directory = os.path.dirname(os.path.abspath(manifestFile))
+    os.makedirs(directory, exist_ok=True)
+    buffer = []
+    n_buffered = 0
+    if append and os.path.exists(manifestFile):
+        manifest = read_manifest(manifestFile)
+        if manifest["shard_size"] != shard_size:
+            raise ValueError("shard_size {} doesn't match the {} of {}".format(shard_size, manifest["shard_size"], manifestFile))
+        n_existing = manifest["n_objects"]
+        last = manifest["shards"][-1] if manifest["shards"] else None
+        if last is not None and last["stop"]-last["start"] < shard_size:
+            #the partial last shard is written again with the new data
+            with h5py.File(os.path.join(directory, last["file"]),'r') as hf:
+                buffer.append({key: hf[key][:] for key in ["X","ids","Y","obs_counts","obs_time"] if key in hf})
+            n_buffered = last["stop"]-last["start"]
+            manifest["shards"].pop()
+            manifest["n_objects"] = last["start"]
+            counts = np.asarray(manifest["class_counts"], dtype=np.int64)
+            counts[0:len(last["class_counts"])] -= np.asarray(last["class_counts"], dtype=np.int64)
+            manifest["class_counts"] = counts.tolist()
+    else:
+        manifest = {"shard_size": shard_size, "n_objects": 0, "class_counts": [], "shards": []}
+        n_existing = 0
+
+    def write_shard(dataset):
+        shard = {"file": "shard_{:05d}.h5".format(len(manifest["shards"])),
+            "start": manifest["n_objects"], "stop": manifest["n_objects"]+len(dataset["ids"])}
+        filename = os.path.join(directory, shard["file"])
+        save_vectors(dataset, filename, **save_options)
+        shard["class_counts"] = np.bincount(np.asarray(dataset["Y"]).astype(np.int64)).tolist()
+        shard["sha256"] = shard_checksum(filename)
+        stat = os.stat(filename)
+        shard["size"], shard["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+        manifest["shards"].append(shard)
+        manifest["n_objects"] = shard["stop"]
+        counts = np.zeros(max(len(manifest["class_counts"]), len(shard["class_counts"])), dtype=np.int64)
+        for class_counts in [manifest["class_counts"], shard["class_counts"]]:
+            counts[0:len(class_counts)] += np.asarray(class_counts, dtype=np.int64)
+        manifest["class_counts"] = counts.tolist()
+
+    for dataset in datasets:
+        buffer.append(dataset)
+        n_buffered += len(dataset["ids"])
+        if n_buffered < shard_size:
+            continue
+        keys = [key for key in ["X","ids","Y","obs_counts","obs_time"] if key in buffer[0]]
+        merged = {key: np.concatenate([d[key] for d in buffer]) for key in keys}
+        n_full = n_buffered//shard_size*shard_size
+        for start in range(0, n_full, shard_size):
+            write_shard(slice_vectors(merged, start, start+shard_size))
+        buffer = [slice_vectors(merged, n_full, n_buffered)]
+        n_buffered -= n_full
+    if n_buffered > 0:
+        keys = [key for key in ["X","ids","Y","obs_counts","obs_time"] if key in buffer[0]]
+        write_shard({key: np.concatenate([d[key] for d in buffer]) for key in keys})
+
+    if cache_key is not None:
+        manifest["cache_key"] = cache_key
+    with open(manifestFile, "w") as f:
+        json.dump(manifest, f, indent=1)
+    #shards of a previous (longer) dataset written in the same directory
+    written = set(shard["file"] for shard in manifest["shards"])
+    for filename in os.listdir(directory):
+        if re.fullmatch(r"shard_\d{5}\.h5", filename) and filename not in written:
+            os.remove(os.path.join(directory, filename))
+    return manifest["n_objects"]-n_existing
+
+def shard_vectors(inputFile, manifestFile, shard_size=100000, block_rows=100000, **save_options):
+    """Splits an existing .hdf5 file written by save_vectors into a sharded dataset
+    Returns
+    -------
+    n_written: int, number of objects written
+    """
+    def blocks():
+        with h5py.File(inputFile,'r') as hf:
+            obs_offsets = observation_offsets(hf)
+            for start in range(0, hf["ids"].shape[0], block_rows):
+                stop = min(start+block_rows, hf["ids"].shape[0])
+                dataset = {key: hf[key][start:stop] for key in ["X","ids","Y","obs_counts"] if key in hf}
+                if obs_offsets is not None:
+                    dataset["obs_time"] = hf["obs_time"][obs_offsets[start]:obs_offsets[stop]]
+                yield dataset
+    return write_vectors_in_shards(blocks(), manifestFile, shard_size, **save_options)